@@ -1,11 +1,9 @@
 from __future__ import division
 import argparse
-import sqlite3
 import datetime
 from subprocess import call
 import rrdtool
 import calendar
-import math
 import time
 from ConfigParser import SafeConfigParser
 from twistedfcp.protocol import FreenetClientProtocol, Message
@@ -19,12 +17,23 @@ import re
 import logging
 import codecs
 from fnprobe.time import toPosix, totalSeconds, timestamp
+from fnprobe.db import unpack_lengths, encode_error_type, hour_start, ShardRouter, connect_reader, shard_path
+from fnprobe import backfill, columns, solver
+import numpy as np
 
 parser = argparse.ArgumentParser(description="Analyze probe results for estimates of peer distribution and network interconnectedness; generate plots.")
 
 # Options.
 parser.add_argument('-d', dest="databaseFile", default="database.sql",\
                     help="Path to database file. Default \"database.sql\"")
+parser.add_argument('--shards', dest='shards', default=False, action='store_true',
+                    help='Read the monthly shards of the database file written with shardByMonth instead of the file itself.')
+parser.add_argument('--columns', dest='columns', default=None,
+                    help='Directory of results exported by export.py to read for the location, peer count, link length, and uptime plots instead of the database.')
+parser.add_argument('--rrd-batch-size', dest='rrdBatchSize', default=1000, type=int,
+                    help='Number of entries to write to the RRD with each update. Default 1000.')
+parser.add_argument('--jobs', dest='jobs', default=1, type=int,
+                    help='Number of processes to read results for the RRD with. Splitting many periods to catch up on between processes takes less time. Default 1.')
 parser.add_argument('-T', '--recentHours', dest="recentHours", default=168, type=int,\
                     help="Number of hours for which a probe is considered recent. Used for peer count histogram and link lengths. Default 168 - one week.")
 parser.add_argument('--histogram-max', dest="histogramMax", default=50, type=int,\
@@ -73,7 +82,17 @@ recent = startTime - datetime.timedelta(hours=args.recentHours)
 log("Recency boundary is {0} ({1}).".format(recent, toPosix(recent)))
 
 log("Connecting to database.")
-db = sqlite3.connect(args.databaseFile)
+if args.shards:
+    db = ShardRouter(args.databaseFile)
+else:
+    db = connect_reader(args.databaseFile)
+
+def cover(start, end):
+    """
+    Make results from start to end available to queries.
+    """
+    if args.shards:
+        db.cover(start, end)
 
 # Period of time to consider samples in a group for an instantaneous estimate.
 # Must be a day or less. If it is more than a day the RRDTool 5-year daily
@@ -125,14 +144,15 @@ except:
     # Database does not exist - create it.
     #
     # Data cannot be added at the time the database starts, and it should have an
-    # entire hour of data before it just like all the rest. As the first entry
-    # should be added after the first hour of data, the database should begin
-    # a second before one hour after the first data.
+    # entire hour of data before it just like all the rest. The database begins
+    # at the start of the hour holding the first data, so that each entry
+    # covers one of the hours of the hourly rollups.
     #
     # An entry is computed including the start of the period and excluding the end.
     #
-    fromTime = datetime.datetime.utcfromtimestamp(db.execute("""select min("time") from "identifier" """).fetchone()[0])
-    toTime = fromTime + shortPeriod
+    if args.shards:
+        db.coverEarliest()
+    fromTime = datetime.datetime.utcfromtimestamp(hour_start(db.execute("""select min("time") from "identifier" """).fetchone()[0]))
     shortPeriodSeconds = int(totalSeconds(shortPeriod))
     log("Creating round robin network size database.")
 
@@ -148,7 +168,7 @@ except:
     rrdtool.create( args.rrd,
                 # If the database already exists don't overwrite it.
                 '--no-overwrite',
-                '--start', str(toPosix(toTime) - 1),
+                '--start', str(toPosix(fromTime)),
                 # Once each hour.
                 '--step', '{0}'.format(shortPeriodSeconds),
                 # Lossless for a year of instantanious; longer for effective estimate. No unknowns allowed.
@@ -161,6 +181,21 @@ except:
               )
 
 if args.runRRD:
+    # Refusals, errors, and store sizes are read from the hourly rollups and
+    # by integer type code, which are incomplete until the backfills after an
+    # upgrade finish. Entries computed before then would stay wrong.
+    if args.shards:
+        pending = []
+        for month in db.months():
+            shard = connect_reader(shard_path(args.databaseFile, month))
+            pending += [ row[0] for row in shard.execute("""select name from migration""") ]
+            shard.close()
+    else:
+        pending = [ row[0] for row in db.execute("""select name from migration""") ]
+    if pending:
+        print("Background migrations are still running: {0}. Run probe.py until they finish before updating the RRD.".format(", ".join(pending)))
+        sys.exit(1)
+
     #
     # Start computation where the stored values left off, if any.
     # If the database is new rrdtool last returns the database start time.
@@ -170,159 +205,66 @@ if args.runRRD:
     toTime = fromTime + shortPeriod
     log("Resuming network size computation for {0}.".format(toTime))
 
-
-    def formula(samples, networkSize):
-        return networkSize * (1 - math.e**(-samples/networkSize))
-
-    def binarySearch(distinctSamples, samples):
-        if math.fabs(samples - distinctSamples) < 3:
-            """Not enough information to make an estimate."""
-            return float('NaN')
-        # Upper and lower are network size guesses.
-        lower = distinctSamples
-        upper = distinctSamples * 2
-
-        #log("Starting: distinct {0}, samples {1}, lower {2}, upper {3}".format(distinctSamples, samples, lower, upper))
-
-        # Find an upper bound - multiply by two until too large.
-        while formula(samples, upper) < distinctSamples:
-            upper *= 2
-
-        while True:
-            #log("lower {0}, upper {1}".format(lower, upper))
-            # Got as close as possible. Lower can be greater than upper with certain
-            # values of mid.
-            if lower >= upper:
-                return lower
-
-            mid = int((upper - lower) / 2) + lower
-            current = formula(samples, mid)
-
-            if current < distinctSamples:
-                lower = mid + 1
-                continue
-            elif current > distinctSamples:
-                upper = mid - 1
-                continue
-            else:
-                # current == distinctSamples:
-                return mid
-
     log("Computing network plot data. In-progress segement is {0}. ({1})".format(startTime, toPosix(startTime)))
 
-    intersectionQuery = """
-    SELECT
-      COUNT(DISTINCT identifier), COUNT(identifier)
-    FROM
-      (SELECT
-        i1.identifier
-       FROM identifier i1
-         JOIN identifier i2
-         USING(identifier)
-       WHERE i1.time BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
-         AND i2.time BETWEEN strftime('%s', ?2) AND strftime('%s', ?3)
-      )
-    """
-
-    #
-    # Perform binary search for network size in:
-    # (distinct samples) = (network size) * (1 - e^(-1 * (samples)/(network size)))
-    # ----Effective size estimate:
-    # Identifiers that appear in the current long time period in the past, as well as
-    # the period of the same length farther back.
-    # ----Instantaneous size estimate:
-    # Identifiers that appear in the current short time period in the past.
+    # The end of each period to compute.
+    ends = []
     while startTime > toTime:
-
-        # Start of current effective size estimate period.
-        fromTimeEffective = toTime - longPeriod
-        # Start of previous effective size estimate period.
-        fromTimeEffectivePrevious = toTime - 2*longPeriod
-
-        weekEffectiveResult = db.execute(intersectionQuery,
-          (fromTimeEffectivePrevious, fromTimeEffective, toTime)).fetchone()
-
-        effectiveSize = binarySearch(weekEffectiveResult[0], weekEffectiveResult[1])
-
-        log("{0}: {1} samples | {2} distinct samples | {3} estimated weekly effective size"
-               .format(toTime, weekEffectiveResult[1], weekEffectiveResult[0], effectiveSize))
-
-        # Start of current daily effective size estimate period.
-        fromTimeDaily = toTime - mediumPeriod
-        # Start of previous daily effective size estimate period.
-        fromTimeDailyPrevious = toTime - 2*mediumPeriod
-
-        dailyEffectiveResult = db.execute(intersectionQuery,
-          (fromTimeDailyPrevious, fromTimeDaily, toTime)).fetchone()
-
-        dailySize = binarySearch(dailyEffectiveResult[0], dailyEffectiveResult[1])
-
-        log("{0}: {1} samples | {2} distinct samples | {3} estimated daily effective size"
-               .format(toTime, dailyEffectiveResult[1], dailyEffectiveResult[0], dailySize))
-
-        # TODO: Add / remove / ignore refusals to provide error bars? More than that needs to be error bars though.
-        # TODO: Take into account refuals for error bars.
-        instantaneousResult = db.execute("""
-        SELECT
-          COUNT(DISTINCT "identifier"), COUNT("identifier")
-        FROM
-          "identifier"
-        WHERE
-          time BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
-        """, (fromTime, toTime)).fetchone()
-
-        instantaneousSize = binarySearch(instantaneousResult[0], instantaneousResult[1])
-        log("{0}: {1} samples | {2} distinct samples | {3} estimated instantaneous size"
-               .format(toTime, instantaneousResult[1], instantaneousResult[0], instantaneousSize))
-
-        # Past week of datastore sizes.
-        sizeResult = db.execute("""
-        SELECT
-          sum("GiB"), count("GiB")
-        FROM
-          "store_size"
-        WHERE
-          "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
-        """, (fromTimeEffective, toTime)).fetchone()
-
-        storeCapacity = float('nan')
-        if sizeResult[1] != 0:
-            meanDatastoreSize = sizeResult[0] / sizeResult[1]
-            # Half of datastore is store; blocks are doubled for FEC, then each
-            # stored ~3 times for redundancy. 1073741824 bytes per GiB, 1/12 of
-            # datastore size is store capacity.
-            storeCapacity = meanDatastoreSize * effectiveSize * 1073741824 / 12
-
-        refused = db.execute("""
-        SELECT
-          count(*)
-        FROM
-          "refused"
-        WHERE
-          "time" BETWEEN strftime('%s', ?1) AND "time" <  strftime('%s', ?2)
-        """, (fromTime, toTime)).fetchone()[0]
-
-        # Get numbers of each error type.
-        errors = []
-        for errorType in errorTypes:
-            errors.append(db.execute("""
-            SELECT
-              count(*)
-            FROM
-              "error"
-            WHERE
-              "error_type" == ?1 AND
-              "time" BETWEEN strftime('%s', ?2) AND strftime('%s', ?3)
-            """, (errorType, fromTime, toTime)).fetchone()[0])
+        ends.append(toTime)
+        toTime += shortPeriod
+
+    # Each process reads the identifier results for the periods it covers
+    # once, in time order. See fnprobe/backfill.py.
+    log("Reading results for {0} periods with {1} processes.".format(len(ends), args.jobs))
+    results = backfill.read(args.databaseFile, args.shards, ends, shortPeriod, mediumPeriod, longPeriod,
+                            [ encode_error_type(errorType) for errorType in errorTypes ], args.jobs)
+
+    if results is not None:
+        #
+        # Solve for network size in:
+        # (distinct samples) = (network size) * (1 - e^(-1 * (samples)/(network size)))
+        # for all periods at once.
+        # ----Effective size estimate:
+        # Identifiers that appear in the current long time period in the past, as well as
+        # the period of the same length farther back.
+        # ----Instantaneous size estimate:
+        # Identifiers that appear in the current short time period in the past.
+        instantaneousSizes = solver.estimate(results["instantaneous"][:, 0], results["instantaneous"][:, 1])
+        dailySizes = solver.estimate(results["daily"][:, 0], results["daily"][:, 1])
+        effectiveSizes = solver.estimate(results["weekly"][:, 0], results["weekly"][:, 1])
+
+        # Half of datastore is store; blocks are doubled for FEC, then each
+        # stored ~3 times for redundancy. 1073741824 bytes per GiB, 1/12 of
+        # datastore size is store capacity. NaN without store sizes.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            meanDatastoreSizes = np.where(results["storeCount"] != 0, results["storeGiB"] / results["storeCount"], float('nan'))
+        storeCapacities = meanDatastoreSizes * effectiveSizes * 1073741824 / 12
 
         # RRDTool format string to explicitly specify the order of the data sources.
         # The first one is implicitly the time of the sample.
-        rrdtool.update( args.rrd,
-            '-t', 'instantaneous-size:daily-size:effective-size:store-capacity:refused:' + join(errorDataSources, ':'),
-                join(map(str, [ toPosix(toTime), instantaneousSize, dailySize, effectiveSize, storeCapacity, refused ] + errors), ':'))
-
-        fromTime = toTime
-        toTime = fromTime + shortPeriod
+        template = 'instantaneous-size:daily-size:effective-size:store-capacity:refused:' + join(errorDataSources, ':')
+
+        # Entries are written in batches, each with a single update call.
+        # rrdtool writes the entries of a call in order and records the time
+        # of each as the last update as it goes, so if interrupted the next
+        # run resumes after the last entry written.
+        entries = []
+        for index, toTime in enumerate(ends):
+            for name, sizes, samples in [ ('weekly effective', effectiveSizes, results["weekly"]),
+                                          ('daily effective', dailySizes, results["daily"]),
+                                          # TODO: Add / remove / ignore refusals to provide error bars? More than that needs to be error bars though.
+                                          # TODO: Take into account refuals for error bars.
+                                          ('instantaneous', instantaneousSizes, results["instantaneous"]) ]:
+                log("{0}: {1} samples | {2} distinct samples | {3} estimated {4} size"
+                       .format(toTime, samples[index, 1], samples[index, 0], sizes[index], name))
+
+            entries.append(join(map(str, [ results["end"][index], instantaneousSizes[index], dailySizes[index], effectiveSizes[index],
+                                           storeCapacities[index], int(results["refused"][index]) ] + map(int, results["errors"][index])), ':'))
+
+            if len(entries) >= args.rrdBatchSize or index == len(ends) - 1:
+                rrdtool.update(args.rrd, '-t', template, *entries)
+                log("Wrote {0} entries through {1}.".format(len(entries), toTime))
+                entries = []
 
     # Graph all available information with a 2-pixel red line.
     lastResult = rrdtool.last(args.rrd)
@@ -423,16 +365,32 @@ def makeHistogram(histMax, results):
 
     return hist
 
+if args.runLocation or args.runPeerCount or args.runLinkLengths or args.runUptime:
+    cover(recent, startTime)
+
+def loadRecent(table):
+    """
+    Returns the exported columns of the table and a mask of its recent rows.
+    """
+    log("Loading exported {0}.".format(table))
+    exported = columns.load(args.columns, table)
+    return exported, columns.window(exported, toPosix(recent), toPosix(startTime))
+
 if args.runLocation:
-    log("Querying database for locations.")
-    locations = db.execute("""
-    SELECT
-      DISTINCT "location"
-    FROM
-      "location"
-    WHERE
-      "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
-    """, (recent, startTime)).fetchall()
+    if args.columns:
+        exported, mask = loadRecent("location")
+        locations = exported["location"][mask]
+        locations = [ (location,) for location in np.unique(locations[~np.isnan(locations)]) ]
+    else:
+        log("Querying database for locations.")
+        locations = db.execute("""
+        SELECT
+          DISTINCT "location"
+        FROM
+          "location"
+        WHERE
+          "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
+        """, (recent, startTime)).fetchall()
     log(recent)
     log(startTime)
 
@@ -445,17 +403,22 @@ if args.runLocation:
     call(["gnuplot","location_dist.gnu"])
 
 if args.runPeerCount:
-    log("Querying database for peer distribution histogram.")
-    rawPeerCounts = db.execute("""
-    SELECT
-      peers, count("peers")
-    FROM
-      "peer_count"
-    WHERE
-      "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
-      GROUP BY "peers"
-      ORDER BY "peers"
-    """, (recent, startTime)).fetchall()
+    if args.columns:
+        exported, mask = loadRecent("peer_count")
+        peers = exported["peers"][mask]
+        rawPeerCounts = zip(*np.unique(peers[peers >= 0], return_counts=True))
+    else:
+        log("Querying database for peer distribution histogram.")
+        rawPeerCounts = db.execute("""
+        SELECT
+          peers, count("peers")
+        FROM
+          "peer_count"
+        WHERE
+          "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
+          GROUP BY "peers"
+          ORDER BY "peers"
+        """, (recent, startTime)).fetchall()
 
     peerCounts = makeHistogram(args.histogramMax, rawPeerCounts)
 
@@ -475,20 +438,23 @@ def writeCDF(data, filename):
     with open(filename, "w") as output:
         height = 1.0/max(1.0, len(data))
         #GNUPlot cumulative adds y values, should add to 1.0 in total.
-        # Lambda: get result out of singleton list so it can be sorted as a number.
-        for entry in sorted(map(lambda entry: entry[0], data)):
+        for entry in sorted(data):
             output.write("{0} {1:%}\n".format(entry, height))
 
 if args.runLinkLengths:
-    log("Querying database for link lengths.")
-    links = db.execute("""
-    SELECT
-      "length"
-    FROM
-      "link_lengths"
-    WHERE
-      "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
-    """, (recent, startTime)).fetchall()
+    if args.columns:
+        exported, mask = loadRecent("peer_count")
+        links = columns.lengths_of(exported, mask)
+    else:
+        log("Querying database for link lengths.")
+        links = unpack_lengths([ row[0] for row in db.execute("""
+        SELECT
+          "lengths"
+        FROM
+          "peer_count"
+        WHERE
+          "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
+        """, (recent, startTime)) ])
 
     writeCDF(links, 'links_output')
 
@@ -496,18 +462,23 @@ if args.runLinkLengths:
     call(["gnuplot","link_length.gnu"])
 
 if args.runUptime:
-    log("Querying database for uptime reported with identifiers.")
     # Note that the uptime percentage on the identifier probes is an integer.
-    uptimes = db.execute("""
-    SELECT
-      "percent", count("percent")
-    FROM
-      "identifier"
-    WHERE
-      "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
-    GROUP BY "percent"
-    ORDER BY "percent"
-    """, (recent, startTime)).fetchall()
+    if args.columns:
+        exported, mask = loadRecent("identifier")
+        percents = exported["percent"][mask]
+        uptimes = zip(*np.unique(percents[percents >= 0], return_counts=True))
+    else:
+        log("Querying database for uptime reported with identifiers.")
+        uptimes = db.execute("""
+        SELECT
+          "percent", count("percent")
+        FROM
+          "identifier"
+        WHERE
+          "time" BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
+        GROUP BY "percent"
+        ORDER BY "percent"
+        """, (recent, startTime)).fetchall()
 
     hist = makeHistogram(args.uptimeHistogramMax, uptimes)
     log("Writing results.")
@@ -0,0 +1,534 @@
+from __future__ import division
+import argparse
+import datetime
+import logging
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+# Benchmarks for probe collection and analysis.
+
+parser = argparse.ArgumentParser(description="Benchmark probe collection and analysis.")
+subparsers = parser.add_subparsers(dest='command')
+
+probeParser = subparsers.add_parser('probe', help='Drive probe.py against a stand-in node at increasing rates. Reports achieved probes/second, reply-to-commit latency percentiles, and writer queue depth at each rate.')
+probeParser.add_argument('--start-rate', dest='startRate', default=60, type=int,
+                         help='Probes/minute of the first step. Default 60.')
+probeParser.add_argument('--max-rate', dest='maxRate', default=7680, type=int,
+                         help='Probes/minute of the last step. The rate doubles each step. Default 7680.')
+probeParser.add_argument('--step-duration', dest='stepDuration', default=30, type=float,
+                         help='Seconds to run each step. Default 30.')
+probeParser.add_argument('--batch-size', dest='writeBatchSize', default=50, type=int,
+                         help='Writer batch size. Default 50.')
+probeParser.add_argument('--batch-interval', dest='writeBatchInterval', default=1000, type=float,
+                         help='Writer batch interval in milliseconds. Default 1000.')
+probeParser.add_argument('--latency', dest='latency', default='exponential:0.5',
+                         help='Stand-in node response latency distribution. See fakenode.py. Default exponential:0.5.')
+probeParser.add_argument('--refused', dest='refusedRate', default=0.05, type=float,
+                         help='Fraction of requests refused. Default 0.05.')
+probeParser.add_argument('--error', dest='errorRate', default=0.02, type=float,
+                         help='Fraction of requests answered with an error. Default 0.02.')
+probeParser.add_argument('--drop', dest='dropRate', default=0, type=float,
+                         help='Fraction of requests never answered. Default 0.')
+probeParser.add_argument('--disconnect', dest='disconnectRate', default=0, type=float,
+                         help='Probability that a request disconnects. Default 0.')
+probeParser.add_argument('--database', dest='databaseFile', default=None,
+                         help='Database file to write to. Default a new temporary database.')
+
+dbParser = subparsers.add_parser('db', help='Compare default sqlite3 connections with the writer and reader profiles of fnprobe.db. Reports results inserted/second and the mean time of analyze.py queries for each.')
+dbParser.add_argument('--results', dest='results', default=200000, type=int,
+                      help='Number of results to insert. Default 200000.')
+dbParser.add_argument('--batch-size', dest='batchSize', default=50, type=int,
+                      help='Results committed per transaction, as with the writer. Default 50.')
+dbParser.add_argument('--days', dest='days', default=14, type=int,
+                      help='Days the results are spread over. Default 14.')
+dbParser.add_argument('--repeat', dest='repeat', default=5, type=int,
+                      help='Times to run each query. Default 5.')
+dbParser.add_argument('--directory', dest='directory', default=None,
+                      help='Directory to create the databases in. Default a new temporary directory.')
+
+sizeParser = subparsers.add_parser('size', help='Compare computing the samples for the size estimates of each hour with the identifier self-join queries analyze.py used to run against streaming the results once through fnprobe.estimate.SizeEstimator, as for a full RRD rebuild. Checks that they agree.')
+sizeParser.add_argument('--results', dest='results', default=100000, type=int,
+                        help='Number of identifier results. Default 100000.')
+sizeParser.add_argument('--days', dest='days', default=28, type=int,
+                        help='Days the results are spread over. Default 28.')
+sizeParser.add_argument('--network-size', dest='networkSize', default=5000, type=int,
+                        help='Number of distinct identifiers results are drawn from. Default 5000.')
+sizeParser.add_argument('--hours', dest='hours', default=168, type=int,
+                        help='Hours to compute, ending with the last. Default 168.')
+
+shardsParser = subparsers.add_parser('shards', help='Check that fnprobe.backfill reads the same results for the RRD from monthly shards as from a single database, over more months than SQLite can attach at once, for periods both on and off the hour. Exits with status 1 if they differ.')
+shardsParser.add_argument('--months', dest='months', default=13, type=int,
+                          help='Months the results are spread over. Default 13.')
+shardsParser.add_argument('--results', dest='results', default=50000, type=int,
+                          help='Number of results. Default 50000.')
+
+solverParser = subparsers.add_parser('solver', help='Compare the binary search analyze.py used to estimate network size with fnprobe.solver on random samples. Checks that the solver agrees with a scalar bisection of the same formula, gives NaN where there are too few repeats, no samples, or no fewer distinct samples than samples, and fits at least as well as the binary search. Exits with status 1 if it does not.')
+solverParser.add_argument('--estimates', dest='estimates', default=100000, type=int,
+                          help='Number of estimates to make. Default 100000.')
+solverParser.add_argument('--max-samples', dest='maxSamples', default=1000000, type=int,
+                          help='Largest number of samples. Default 1000000.')
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def benchmarkProbe(args):
+    # Imported here as probe.py sets up logging and Twisted on import.
+    import probe
+    from twisted.enterprise import adbapi
+    from twisted.internet import defer, reactor, task
+    from fakenode import FakeNetwork, FakeNodeFactory, latencyDistribution
+    from fnprobe.db import init_database, configure_writer
+    from fnprobe.writer import BatchWriter
+
+    directory = tempfile.mkdtemp()
+    databaseFile = args.databaseFile or os.path.join(directory, 'database.sql')
+
+    nodeFactory = FakeNodeFactory(FakeNetwork(5000), latencyDistribution(args.latency), args.refusedRate,
+                                  args.errorRate, args.dropRate, args.disconnectRate)
+    port = reactor.listenTCP(0, nodeFactory, interface='127.0.0.1').getHost().port
+
+    probeArgs = probe.Arguments()
+    probeArgs.types = [ "BANDWIDTH", "BUILD", "IDENTIFIER", "LINK_LENGTHS", "LOCATION", "STORE_SIZE", "UPTIME_48H", "UPTIME_7D" ]
+    probeArgs.hopsToLive = 25
+    probeArgs.timeout = 95
+    probeArgs.maxPending = 10000
+    probeArgs.congestionControl = False
+    probeArgs.probeRate = args.startRate
+    probeArgs.probePeriod = 60 / args.startRate
+    probeArgs.host = '127.0.0.1'
+    probeArgs.port = port
+    probeArgs.node = '127.0.0.1:{0}'.format(port)
+
+    pool = adbapi.ConnectionPool('sqlite3', databaseFile, timeout=60, cp_max=1, check_same_thread=False,
+                                 cp_openfun=configure_writer)
+    writer = BatchWriter(pool, probe.insertResult, args.writeBatchSize, args.writeBatchInterval / 1000,
+                         4, 0.5, os.path.join(directory, 'probe.spool'))
+    latencies = []
+    writer.latencyObserver = latencies.append
+    factory = probe.FCPReconnectingFactory(probeArgs, writer)
+
+    @defer.inlineCallbacks
+    def run():
+        yield pool.runWithConnection(init_database)
+        reactor.connectTCP('127.0.0.1', port, factory)
+        # Wait for the node hello to start the send loop.
+        while factory.sendLoop is None or not factory.sendLoop.running:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+
+        print("{0:>8} {1:>10} {2:>10} {3:>8} {4:>8} {5:>8} {6:>8} {7:>9} {8:>9}".format(
+              'rate/min', 'sent/s', 'stored/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'mean q', 'max q'))
+
+        rate = args.startRate
+        while rate <= args.maxRate:
+            probeArgs.probePeriod = 60 / rate
+            factory.setPeriod(probeArgs.probePeriod)
+
+            requests = nodeFactory.requests
+            stored = writer.totalResults
+            del latencies[:]
+            depths = []
+            for _ in range(int(args.stepDuration * 10)):
+                yield task.deferLater(reactor, 0.1, lambda: None)
+                depths.append(writer.depth())
+
+            stepLatencies = sorted(latencies)
+            print("{0:>8} {1:>10.1f} {2:>10.1f} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f} {7:>9.1f} {8:>9}".format(
+                  rate,
+                  (nodeFactory.requests - requests) / args.stepDuration,
+                  (writer.totalResults - stored) / args.stepDuration,
+                  percentile(stepLatencies, 0.5) * 1000,
+                  percentile(stepLatencies, 0.9) * 1000,
+                  percentile(stepLatencies, 0.99) * 1000,
+                  percentile(stepLatencies, 1) * 1000,
+                  sum(depths) / len(depths),
+                  max(depths)))
+
+            rate *= 2
+
+        if nodeFactory.disconnects:
+            print("{0} disconnects injected.".format(nodeFactory.disconnects))
+
+        factory.stopTrying()
+        if factory.sendLoop.running:
+            factory.sendLoop.stop()
+        yield writer.stop()
+        pool.close()
+
+    def done(result):
+        shutil.rmtree(directory)
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: run().addErrback(lambda failure: failure.printTraceback()).addBoth(done))
+    reactor.run()
+
+# Queries as run by analyze.py --rrd for one hour, and by its distribution plots.
+dbQueries = [
+    ('effective size', """
+    SELECT
+      COUNT(DISTINCT identifier), COUNT(identifier)
+    FROM
+      (SELECT
+        i1.identifier
+       FROM identifier i1
+         JOIN identifier i2
+         USING(identifier)
+       WHERE i1.time BETWEEN ?1 AND ?2
+         AND i2.time BETWEEN ?2 AND ?3
+      )
+    """),
+    ('instantaneous size', """
+    SELECT
+      COUNT(DISTINCT "identifier"), COUNT("identifier")
+    FROM
+      "identifier"
+    WHERE
+      time BETWEEN ?2 AND ?3
+    """),
+    ('link lengths', """
+    SELECT
+      "lengths"
+    FROM
+      "peer_count"
+    WHERE
+      "time" BETWEEN ?1 AND ?3
+    """),
+    ('errors by type', """
+    SELECT
+      "error_type", sum("count")
+    FROM
+      "error_hourly"
+    WHERE
+      "hour" >= ?1 AND "hour" < ?3
+    GROUP BY
+      "error_type"
+    """),
+]
+
+def benchmarkDb(args):
+    import probe
+    from fakenode import FakeNetwork
+    from fnprobe.db import create_new, connect_reader, connect_writer
+
+    directory = args.directory or tempfile.mkdtemp()
+    network = FakeNetwork(5000)
+    types = [ "BANDWIDTH", "BUILD", "IDENTIFIER", "LINK_LENGTHS", "LOCATION", "STORE_SIZE", "UPTIME_48H", "UPTIME_7D" ]
+    end = int(time.time())
+    start = end - args.days * 86400
+
+    # The same results for each profile.
+    results = []
+    for _ in range(args.results):
+        probeType = random.choice(types)
+        outcome = random.random()
+        if outcome < 0.05:
+            header, fields = 'ProbeRefused', {}
+        elif outcome < 0.07:
+            header, fields = 'ProbeError', { 'Type': 'TIMEOUT', 'Local': 'true' }
+        else:
+            header, fields = network.result(probeType)
+            fields = dict((key, str(value)) for key, value in fields)
+        results.append((header, 25, fields, random.randint(start, end), random.uniform(0.5, 5), probeType, 'benchmark'))
+    results.sort(key=lambda result: result[3])
+
+    profiles = [ ('default', sqlite3.connect, sqlite3.connect), ('tuned', connect_writer, connect_reader) ]
+
+    print("{0:<20} {1:>12} {2:>12}".format('', *[ name for name, writer, reader in profiles ]))
+
+    rates = []
+    for name, connectWriter, connectReader in profiles:
+        path = os.path.join(directory, '{0}.sql'.format(name))
+        for existing in [ path, path + '-wal', path + '-shm' ]:
+            if os.path.exists(existing):
+                os.remove(existing)
+
+        db = connectWriter(path)
+        create_new(db)
+        db.commit()
+
+        began = time.time()
+        for index in range(0, len(results), args.batchSize):
+            for result in results[index:index + args.batchSize]:
+                probe.insertResult(db, *result)
+            db.commit()
+        rates.append(len(results) / (time.time() - began))
+        db.execute("analyze")
+        db.close()
+    print("{0:<20} {1:>12.0f} {2:>12.0f}".format('inserts/s', *rates))
+
+    # Query the last day, and the day before it.
+    parameters = (end - 2 * 86400, end - 86400, end)
+    for query, sql in dbQueries:
+        times = []
+        for name, connectWriter, connectReader in profiles:
+            db = connectReader(os.path.join(directory, '{0}.sql'.format(name)))
+            began = time.time()
+            for _ in range(args.repeat):
+                db.execute(sql, parameters).fetchall()
+            times.append((time.time() - began) / args.repeat * 1000)
+            db.close()
+        print("{0:<20} {1:>12.1f} {2:>12.1f}".format(query + ' ms', *times))
+
+    if args.directory is None:
+        shutil.rmtree(directory)
+
+def benchmarkSize(args):
+    from fnprobe.db import create_new
+    from fnprobe.estimate import SizeEstimator, intersectionQuery, instantaneousQuery, identifierStreamQuery
+    from fnprobe.time import toPosix
+
+    directory = tempfile.mkdtemp()
+    db = sqlite3.connect(os.path.join(directory, 'size.sql'))
+    create_new(db)
+    end = int(time.time()) // 3600 * 3600
+    start = end - args.days * 86400
+    # Some results are on the hour, where adjacent periods meet.
+    db.executemany("""insert into identifier(time, htl, identifier, percent, duration, node) values(?, 25, ?, 50, 1, 1)""",
+                   sorted([ (random.choice([ random.randint(start, end), random.randint(start // 3600, end // 3600) * 3600 ]),
+                             random.randint(1, args.networkSize)) for _ in range(args.results) ]))
+    db.commit()
+    db.execute("analyze")
+
+    short, medium, long = datetime.timedelta(hours=1), datetime.timedelta(hours=24), datetime.timedelta(hours=168)
+    ends = [ datetime.datetime.utcfromtimestamp(end - hour * 3600) for hour in reversed(range(args.hours)) ]
+
+    began = time.time()
+    queried = []
+    for toTime in ends:
+        queried.append((db.execute(instantaneousQuery, (toTime - short, toTime)).fetchone(),
+                        db.execute(intersectionQuery, (toTime - 2*medium, toTime - medium, toTime)).fetchone(),
+                        db.execute(intersectionQuery, (toTime - 2*long, toTime - long, toTime)).fetchone()))
+    queryTime = time.time() - began
+
+    began = time.time()
+    estimator = SizeEstimator(db.execute(identifierStreamQuery, (toPosix(ends[0] - 2*long), toPosix(ends[-1]) + 1)), 3600, 24 * 3600, 168 * 3600)
+    streamed = [ estimator.advance(toPosix(toTime)) for toTime in ends ]
+    streamTime = time.time() - began
+
+    db.close()
+    shutil.rmtree(directory)
+
+    mismatches = [ toTime for toTime, old, new in zip(ends, queried, streamed) if map(tuple, old) != map(tuple, new) ]
+    print("{0} hours: queries {1:.2f} s, streaming {2:.2f} s, {3:.1f}x faster".format(len(ends), queryTime, streamTime, queryTime / max(streamTime, 1e-9)))
+    if mismatches:
+        print("Results differ at {0} hours, first at {1}.".format(len(mismatches), mismatches[0]))
+    else:
+        print("Results agree.")
+
+def benchmarkShards(args):
+    import numpy as np
+    from fnprobe import backfill
+    from fnprobe.db import create_new, rebuild_rollups, shard_month, shard_path, errorTypes
+
+    directory = tempfile.mkdtemp()
+    databaseFile = os.path.join(directory, 'database.sql')
+    end = int(time.time()) // 3600 * 3600
+    start = end - args.months * 31 * 86400
+
+    inserts = [
+        ("""insert into identifier(time, htl, identifier, percent, duration, node) values(?, 25, ?, 50, 1, 1)""", lambda: random.randint(1, 2000)),
+        ("""insert into refused(time, htl, probe_type, duration, node) values(?, 25, ?, 1, 1)""", lambda: random.randint(0, 7)),
+        ("""insert into error(time, htl, probe_type, error_type, duration, local, node) values(?, 25, 0, ?, 1, 'true', 1)""", lambda: random.randint(0, 5)),
+        ("""insert into store_size(time, htl, GiB, duration, node) values(?, 25, ?, 1, 1)""", lambda: random.uniform(1, 100)),
+    ]
+
+    # The same results in a single database and in monthly shards. Some are
+    # written just after the end of the month they are from, into the next
+    # month's shard.
+    databases = {}
+    def connect(path):
+        if path not in databases:
+            databases[path] = sqlite3.connect(path)
+            create_new(databases[path])
+        return databases[path]
+
+    for _ in range(args.results):
+        resultTime = random.randint(start, end)
+        written = resultTime + random.choice([ 0, 0, 0, random.randint(0, 3600) ])
+        sql, value = random.choice(inserts[:1] * 3 + inserts)
+        parameters = (resultTime, value())
+        connect(databaseFile).execute(sql, parameters)
+        connect(shard_path(databaseFile, shard_month(written))).execute(sql, parameters)
+
+    for db in databases.values():
+        rebuild_rollups(db)
+        db.commit()
+        db.close()
+
+    short, medium, long = datetime.timedelta(hours=1), datetime.timedelta(hours=24), datetime.timedelta(hours=168)
+    errorCodes = [ errorType.index for errorType in errorTypes ]
+
+    differ = False
+    for offset in [ 0, 1234 ]:
+        ends = [ datetime.datetime.utcfromtimestamp(toTime) for toTime in range(start + 2 * 168 * 3600 + offset, end, 3600) ]
+
+        began = time.time()
+        single = backfill.read(databaseFile, False, ends, short, medium, long, errorCodes)
+        singleTime = time.time() - began
+
+        began = time.time()
+        sharded = backfill.read(databaseFile, True, ends, short, medium, long, errorCodes)
+        shardedTime = time.time() - began
+
+        mismatched = [ key for key in backfill.keys if not np.allclose(single[key], sharded[key], rtol=1e-12, atol=0) ]
+        print("{0} hours starting {1} seconds past the hour from {2} shards: single database {3:.2f} s, shards {4:.2f} s".format(
+              len(ends), offset, len(databases) - 1, singleTime, shardedTime))
+        if mismatched:
+            differ = True
+            print("Results differ in {0}.".format(", ".join(mismatched)))
+        else:
+            print("Results agree.")
+
+    shutil.rmtree(directory)
+    if differ:
+        exit(1)
+
+def binarySearch(distinctSamples, samples):
+    """
+    Network size estimate as analyze.py computed it before fnprobe.solver.
+    """
+    def formula(samples, networkSize):
+        return networkSize * (1 - math.e**(-samples/networkSize))
+
+    if math.fabs(samples - distinctSamples) < 3:
+        return float('NaN')
+    lower = distinctSamples
+    upper = distinctSamples * 2
+
+    while formula(samples, upper) < distinctSamples:
+        upper *= 2
+
+    while True:
+        if lower >= upper:
+            return lower
+
+        mid = int((upper - lower) / 2) + lower
+        current = formula(samples, mid)
+
+        if current < distinctSamples:
+            lower = mid + 1
+        elif current > distinctSamples:
+            upper = mid - 1
+        else:
+            return mid
+
+def bisect(distinctSamples, samples):
+    """
+    Network size solving the formula fnprobe.solver uses, one estimate at a
+    time by bisection to the limit of floating point precision. NaN where
+    there is nothing to estimate from.
+    """
+    def formula(networkSize):
+        return -networkSize * math.expm1(-samples / networkSize)
+
+    if distinctSamples <= 0 or samples - distinctSamples < 3:
+        return float('NaN')
+
+    # Fewer distinct samples are expected from a network as large as them.
+    lower = float(distinctSamples)
+    upper = lower * 2
+    while formula(upper) < distinctSamples:
+        lower = upper
+        upper *= 2
+
+    while True:
+        mid = (lower + upper) / 2
+        if not lower < mid < upper:
+            return mid
+        if formula(mid) < distinctSamples:
+            lower = mid
+        else:
+            upper = mid
+
+def benchmarkSolver(args):
+    import numpy as np
+    from fnprobe import solver
+
+    # Samples from a few to the maximum, spread over orders of magnitude,
+    # with from almost all to almost none of them repeats.
+    samples = []
+    distinct = []
+    for _ in range(args.estimates):
+        count = int(10 ** random.uniform(0, math.log10(args.maxSamples)))
+        samples.append(count)
+        distinct.append(random.choice([ random.randint(1, count), max(1, count - random.randint(0, 5)) ]))
+
+    # None, all, or more than all samples distinct, and no samples at all.
+    # None of these can be estimated from.
+    for count in [ 0, 1, 3, 10, args.maxSamples ]:
+        for d in [ 0, count, count + 1, count + 5 ]:
+            samples.append(count)
+            distinct.append(d)
+
+    began = time.time()
+    # The binary search never ends unless there are fewer distinct samples
+    # than samples.
+    searched = [ binarySearch(d, s) if 0 < d < s else float('NaN') for d, s in zip(distinct, samples) ]
+    searchTime = time.time() - began
+
+    began = time.time()
+    solved = solver.estimate(np.array(distinct), np.array(samples))
+    solveTime = time.time() - began
+
+    expected = [ bisect(d, s) for d, s in zip(distinct, samples) ]
+
+    # The bisection and the solver solve the same formula, so they must agree
+    # on where there is an estimate and closely on what it is.
+    wrong = []
+    for d, s, reference, new in zip(distinct, samples, expected, solved):
+        if math.isnan(reference) or math.isnan(new):
+            if not (math.isnan(reference) and math.isnan(new)):
+                wrong.append((d, s, reference, new))
+        elif abs(new - reference) > 1e-6 * reference:
+            wrong.append((d, s, reference, new))
+
+    # Scalars must give the same as arrays.
+    for d, s, new in zip(distinct, samples, solved)[:100] + zip(distinct, samples, solved)[-20:]:
+        single = solver.estimate(d, s)
+        if not isinstance(single, float) or not (single == new or (math.isnan(single) and math.isnan(new))):
+            wrong.append((d, s, new, single))
+
+    # The binary search only finds an integer, and can stop one away from the
+    # closest one. For sizes far larger than the samples its formula loses
+    # precision, so there the solver must instead fit at least as well.
+    disagree = 0
+    for d, s, old, new in zip(distinct, samples, searched, solved):
+        if math.isnan(old) or math.isnan(new):
+            disagree += not (math.isnan(old) and math.isnan(new))
+        elif abs(old - new) > 1 and abs(solver.formula(s, new) - d) > abs(solver.formula(s, old) - d):
+            disagree += 1
+
+    residual = np.nanmax(np.abs(solver.formula(np.array(samples), solved) - distinct) / np.maximum(distinct, 1))
+    print("{0} estimates: binary search {1:.3f} s, solver {2:.3f} s, {3:.1f}x faster".format(len(samples), searchTime, solveTime, searchTime / max(solveTime, 1e-9)))
+    print("{0} disagree with the binary search. Largest relative residual of the solver {1:.2g}.".format(disagree, residual))
+
+    for d, s, reference, new in wrong[:10]:
+        print("{0} distinct of {1} samples: expected {2!r}, solver gave {3!r}.".format(d, s, reference, new))
+    if wrong or disagree:
+        print("{0} estimates wrong.".format(len(wrong) + disagree))
+        exit(1)
+    print("Estimates agree.")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s", level=logging.WARNING)
+
+    if args.command == 'probe':
+        benchmarkProbe(args)
+    elif args.command == 'db':
+        benchmarkDb(args)
+    elif args.command == 'size':
+        benchmarkSize(args)
+    elif args.command == 'shards':
+        benchmarkShards(args)
+    elif args.command == 'solver':
+        benchmarkSolver(args)
@@ -0,0 +1,71 @@
+from __future__ import division
+import argparse
+import logging
+import time
+from string import split
+from fnprobe.db import connect_writer, compactableTables, compact_step, incremental_vacuum
+
+parser = argparse.ArgumentParser(description="Compact probe results older than their retention into hourly aggregates, and return the space they took to the filesystem. Can be run while probe.py is running.")
+parser.add_argument('-d', dest="databaseFile", default="database.sql",
+                    help="Database file to compact, default \"database.sql\". With shardByMonth run it on each shard.")
+parser.add_argument('--days', dest="days", default=30, type=int,
+                    help="Days of results to keep in tables not listed in --retention. Default 30.")
+parser.add_argument('--retention', dest="retention", default="",
+                    help="Comma-separated table:days pairs overriding --days for those tables, for example \"identifier:60,error:7\". Days of \"forever\" keeps all results of the table.")
+parser.add_argument('--batch-size', dest="batchSize", default=1000, type=int,
+                    help="Results to compact per transaction. Smaller batches hold the database lock for less time. Default 1000.")
+parser.add_argument('--pause', dest="pause", default=0.05, type=float,
+                    help="Seconds to wait between batches so that probe.py can write. Default 0.05.")
+parser.add_argument('--vacuum-pages', dest="vacuumPages", default=1000, type=int,
+                    help="Free pages to return to the filesystem per transaction afterward. Default 1000.")
+parser.add_argument('--enable-incremental-vacuum', dest="enableVacuum", default=False, action='store_true',
+                    help="Switch a database created before version 10 to incremental vacuum. This rewrites the whole database, during which probe.py cannot write to it, so stop it first.")
+
+args = parser.parse_args()
+
+logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s", level=logging.INFO)
+
+retention = dict((table, args.days) for table in compactableTables)
+for entry in filter(None, split(args.retention, ",")):
+    table, days = split(entry.strip(), ":")
+    if table not in retention:
+        parser.error("Cannot compact unknown table \"{0}\". Tables are {1}.".format(table, ", ".join(compactableTables)))
+    retention[table] = None if days == "forever" else int(days)
+
+db = connect_writer(args.databaseFile)
+
+if args.enableVacuum:
+    logging.warning("Enabling incremental vacuum. This rewrites the database.")
+    db.execute("""PRAGMA auto_vacuum = INCREMENTAL""")
+    db.execute("""vacuum""")
+
+# Results not yet added to the rollups by a backfill would be lost.
+pending = [ row[0] for row in db.execute("""select name from migration""") ]
+if pending:
+    logging.error("Background migrations are still running: {0}. Run probe.py until they finish before compacting.".format(", ".join(pending)))
+    db.close()
+    exit(1)
+
+now = time.time()
+for table in compactableTables:
+    if retention[table] is None:
+        continue
+
+    total = 0
+    while True:
+        compacted = compact_step(db, table, now - retention[table] * 24 * 60 * 60, args.batchSize)
+        total += compacted
+        if compacted < args.batchSize:
+            break
+        time.sleep(args.pause)
+
+    logging.info("Compacted {0} results from {1}.".format(total, table))
+
+if db.execute("""PRAGMA auto_vacuum""").fetchone()[0] != 2:
+    logging.warning("This database does not use incremental vacuum, so the space freed will be reused but the file will not shrink. See --enable-incremental-vacuum.")
+else:
+    while incremental_vacuum(db, args.vacuumPages):
+        time.sleep(args.pause)
+    logging.info("Returned free pages to the filesystem.")
+
+db.close()
@@ -0,0 +1,27 @@
+import argparse
+from fnprobe.db import connect_reader
+from fnprobe.columns import export
+
+parser = argparse.ArgumentParser(description="Export probe results to a directory of .npy column files for analyze.py --columns. Each run appends the results added since the last.")
+parser.add_argument('-d', dest="databaseFile", default="database.sql",
+                    help="Database file to export, default \"database.sql\".")
+parser.add_argument('-o', dest="directory", default="columns",
+                    help="Directory to export to, default \"columns\".")
+parser.add_argument('--batch-size', dest="batchSize", default=100000, type=int,
+                    help="Rows to fetch and append at once. Default 100000.")
+
+args = parser.parse_args()
+
+db = connect_reader(args.databaseFile)
+
+# Type codes and packed link lengths are converted in place by the
+# background migrations, and rows already exported would not be updated.
+pending = [ row[0] for row in db.execute("""select name from migration""") ]
+if pending:
+    print("Background migrations are still running: {0}. Run probe.py until they finish before exporting.".format(", ".join(pending)))
+    exit(1)
+
+for table, count in sorted(export(db, args.directory, args.batchSize).items()):
+    print("Exported {0} rows from {1}.".format(count, table))
+
+db.close()
@@ -0,0 +1,206 @@
+from __future__ import division
+import argparse
+import logging
+import math
+import random
+from string import join
+from twisted.internet import reactor, protocol
+from twisted.protocols.basic import LineReceiver
+
+# Stands in for a Freenet node's FCP interface so that probe.py can be tested
+# and load tested without a live node. Answers ClientHello and ProbeRequest
+# with generated results, refusals, and errors.
+
+errorTypes = [ "DISCONNECTED", "OVERLOAD", "TIMEOUT", "UNKNOWN", "UNRECOGNIZED_TYPE", "CANNOT_FORWARD" ]
+
+def latencyDistribution(spec):
+	"""
+	Parses a latency distribution of the form name:mean in seconds, where name
+	is constant, uniform, exponential, or lognormal. Returns a function which
+	samples it.
+	"""
+	name, mean = spec.split(':')
+	mean = float(mean)
+
+	if name == 'constant':
+		return lambda: mean
+	elif name == 'uniform':
+		return lambda: random.uniform(0, 2 * mean)
+	elif mean <= 0:
+		return lambda: 0
+	elif name == 'exponential':
+		return lambda: random.expovariate(1 / mean)
+	elif name == 'lognormal':
+		# Sigma 1, with mu chosen so that the mean e^(mu + sigma^2 / 2) is as given.
+		mu = math.log(mean) - 0.5
+		return lambda: random.lognormvariate(mu, 1)
+
+	raise argparse.ArgumentTypeError("Unknown latency distribution '{0}'.".format(name))
+
+class FakeNetwork(object):
+	"""
+	A population of nodes which results are drawn from, so that identifier
+	results repeat as they would on a network of the given size.
+	"""
+	def __init__(self, size):
+		self.nodes = []
+		for _ in range(size):
+			peers = random.randint(1, 40)
+			location = random.random()
+			self.nodes.append({
+				'identifier': random.randint(0, 2**63 - 1),
+				'location': location,
+				'peers': [ abs(location - random.random()) for _ in range(peers) ],
+				'bandwidth': random.uniform(10, 500),
+				'build': random.choice([ 1465, 1466, 1467 ]),
+				'storeSize': random.uniform(1, 100),
+				'uptime': random.uniform(0, 100),
+			})
+
+	def result(self, probeType):
+		"""
+		Returns the message name and fields of a result of the given type.
+		"""
+		node = random.choice(self.nodes)
+
+		if probeType == 'BANDWIDTH':
+			return 'ProbeBandwidth', [ ('OutputBandwidth', node['bandwidth']) ]
+		elif probeType == 'BUILD':
+			return 'ProbeBuild', [ ('Build', node['build']) ]
+		elif probeType == 'IDENTIFIER':
+			return 'ProbeIdentifier', [ ('ProbeIdentifier', node['identifier']), ('UptimePercent', int(node['uptime'])) ]
+		elif probeType == 'LINK_LENGTHS':
+			return 'ProbeLinkLengths', [ ('LinkLengths', join(map(str, node['peers']), ';')) ]
+		elif probeType == 'LOCATION':
+			return 'ProbeLocation', [ ('Location', node['location']) ]
+		elif probeType == 'STORE_SIZE':
+			return 'ProbeStoreSize', [ ('StoreSize', node['storeSize']) ]
+		elif probeType in [ 'UPTIME_48H', 'UPTIME_7D' ]:
+			return 'ProbeUptime', [ ('UptimePercent', node['uptime']) ]
+
+		return 'ProbeError', [ ('Type', 'UNRECOGNIZED_TYPE'), ('Local', 'true') ]
+
+class FakeNodeProtocol(LineReceiver):
+	delimiter = '\n'
+
+	def connectionMade(self):
+		self.name = None
+		self.fields = {}
+		self.pending = []
+		self.factory.connections.append(self)
+
+	def connectionLost(self, reason):
+		self.factory.connections.remove(self)
+		for call in self.pending:
+			if call.active():
+				call.cancel()
+
+	def lineReceived(self, line):
+		line = line.rstrip('\r')
+		if self.name is None:
+			self.name = line
+		elif line == 'EndMessage':
+			self.messageReceived(self.name, self.fields)
+			self.name = None
+			self.fields = {}
+		elif '=' in line:
+			key, value = line.split('=', 1)
+			self.fields[key] = value
+
+	def sendFCP(self, name, fields):
+		self.transport.write(join([ name ] + [ '{0}={1}'.format(key, value) for key, value in fields ] + [ 'EndMessage', '' ], '\n'))
+
+	def messageReceived(self, name, fields):
+		if name == 'ClientHello':
+			self.sendFCP('NodeHello', [ ('FCPVersion', '2.0'), ('Node', 'Fred'), ('Version', 'Fred,0.7,1.0,1466'),
+			                            ('Build', '1466'), ('ConnectionIdentifier', random.getrandbits(64)) ])
+		elif name == 'ProbeRequest':
+			self.factory.probeRequested(self, fields)
+		elif name == 'Disconnect':
+			self.transport.loseConnection()
+		else:
+			logging.warning("Ignoring unsupported message '{0}'.".format(name))
+
+	def respond(self, identifier, name, fields):
+		if self.transport is not None and self.connected:
+			self.sendFCP(name, [ ('Identifier', identifier) ] + fields)
+
+class FakeNodeFactory(protocol.ServerFactory):
+	"""
+	Responds to probe requests after a sampled latency with a refusal at
+	refusedRate, an error at errorRate, no response at all at dropRate, and
+	otherwise a result. Each request disconnects the client with probability
+	disconnectRate.
+	"""
+	protocol = FakeNodeProtocol
+
+	def __init__(self, network, latency, refusedRate=0, errorRate=0, dropRate=0, disconnectRate=0):
+		self.network = network
+		self.latency = latency
+		self.refusedRate = refusedRate
+		self.errorRate = errorRate
+		self.dropRate = dropRate
+		self.disconnectRate = disconnectRate
+		self.connections = []
+
+		self.requests = 0
+		self.disconnects = 0
+
+	def probeRequested(self, proto, fields):
+		self.requests += 1
+		identifier = fields.get('Identifier')
+		probeType = fields.get('Type')
+
+		if random.random() < self.disconnectRate:
+			self.disconnects += 1
+			proto.transport.loseConnection()
+			return
+
+		outcome = random.random()
+		if outcome < self.dropRate:
+			return
+		outcome -= self.dropRate
+
+		if outcome < self.refusedRate:
+			name, result = 'ProbeRefused', []
+		elif outcome < self.refusedRate + self.errorRate:
+			name, result = 'ProbeError', [ ('Type', random.choice(errorTypes)), ('Local', random.choice([ 'true', 'false' ])) ]
+		else:
+			name, result = self.network.result(probeType)
+
+		call = reactor.callLater(self.latency(), proto.respond, identifier, name, result)
+		proto.pending.append(call)
+		# Drop calls which have fired to keep the list short.
+		if len(proto.pending) > 1000:
+			proto.pending = [ pending for pending in proto.pending if pending.active() ]
+
+def main():
+	parser = argparse.ArgumentParser(description="Stand-in Freenet node FCP interface which answers probe requests with generated results.")
+	parser.add_argument('--port', dest='port', default=9481, type=int,
+	                    help='Port to listen on. Default 9481.')
+	parser.add_argument('--interface', dest='interface', default='127.0.0.1',
+	                    help='Interface to listen on. Default 127.0.0.1.')
+	parser.add_argument('--network-size', dest='networkSize', default=5000, type=int,
+	                    help='Number of nodes results are drawn from. Default 5000.')
+	parser.add_argument('--latency', dest='latency', default='exponential:2', type=latencyDistribution,
+	                    help='Response latency distribution as name:mean seconds, where name is constant, uniform, exponential, or lognormal. Default exponential:2.')
+	parser.add_argument('--refused', dest='refusedRate', default=0.05, type=float,
+	                    help='Fraction of requests refused. Default 0.05.')
+	parser.add_argument('--error', dest='errorRate', default=0.02, type=float,
+	                    help='Fraction of requests answered with an error. Default 0.02.')
+	parser.add_argument('--drop', dest='dropRate', default=0, type=float,
+	                    help='Fraction of requests never answered. Default 0.')
+	parser.add_argument('--disconnect', dest='disconnectRate', default=0, type=float,
+	                    help='Probability that a request disconnects the client. Default 0.')
+	args = parser.parse_args()
+
+	logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s", level=logging.INFO)
+
+	factory = FakeNodeFactory(FakeNetwork(args.networkSize), args.latency, args.refusedRate,
+	                          args.errorRate, args.dropRate, args.disconnectRate)
+	reactor.listenTCP(args.port, factory, interface=args.interface)
+	logging.info("Listening on {0}:{1}.".format(args.interface, args.port))
+	reactor.run()
+
+if __name__ == '__main__':
+	main()
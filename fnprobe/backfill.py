@@ -0,0 +1,178 @@
+from __future__ import division
+import multiprocessing
+import string
+import numpy as np
+from fnprobe.db import ShardRouter, connect_reader
+from fnprobe.estimate import SizeEstimator, identifierStreamQuery
+from fnprobe.time import toPosix, totalSeconds
+
+# analyze.py --rrd computes an entry for each period from the last one in the
+# RRD up to the present. The results each entry is computed from are read
+# here, and can be split into contiguous chunks of periods read in parallel
+# by worker processes, each with its own read-only connection. Entries are
+# returned in time order. Monthly shards are read a month at a time, so that
+# no more than two are attached at once however many the range spans. Counts are read with one query per table for each
+# chunk rather than for each period: from the hourly rollups when every
+# period is whole hours, and otherwise from the raw results, as for RRDs
+# created before the rollups whose periods start part way through an hour.
+
+# The results for a sequence of periods are a dictionary of arrays with an
+# entry for each period:
+# * end: POSIX time the period ends.
+# * instantaneous, daily, weekly: (distinct samples, samples) of each size
+#   estimate.
+# * storeGiB, storeCount: Sum of store sizes in GiB and number of them over
+#   the long period.
+# * refused: Refusals.
+# * errors: Count of each error type, in the order of errorCodes.
+keys = [ "end", "instantaneous", "daily", "weekly", "storeGiB", "storeCount", "refused", "errors" ]
+
+class Totals(object):
+	"""
+	Totals of values at POSIX times from which the total over any range of
+	times can be found without querying again. Rows of an hourly rollup are
+	at the start of their hour, so they give the totals over ranges of whole
+	hours.
+	"""
+	def __init__(self, rows, columns):
+		"""
+		rows are the time, column index, and value of each row. columns is the
+		number of column indexes.
+		"""
+		rows = np.array(list(rows), dtype=float).reshape(-1, 3)
+		rows = rows[np.argsort(rows[:, 0], kind='mergesort')]
+		self.times = rows[:, 0]
+
+		values = np.zeros((len(rows), columns))
+		values[np.arange(len(rows)), rows[:, 1].astype(int)] = rows[:, 2]
+		# Cumulative totals before each row.
+		self.cumulative = np.vstack([ np.zeros((1, columns)), np.cumsum(values, axis=0) ])
+
+	def between(self, starts, ends):
+		"""
+		Returns the totals from each of an array of POSIX times up to but not
+		including the corresponding one of another, with a row for each.
+		"""
+		return self.cumulative[np.searchsorted(self.times, ends)] - self.cumulative[np.searchsorted(self.times, starts)]
+
+def select(db, query, start, end):
+	"""
+	Yields the rows of a query over the POSIX times from ?1 up to ?2, given
+	start and end. With a ShardRouter the query is run over each month of the
+	range in turn, so rows are in time order if the query orders them.
+	"""
+	spans = db.spans(start, end) if isinstance(db, ShardRouter) else [ (start, end) ]
+	for spanStart, spanEnd in spans:
+		cursor = db.execute(query, (int(spanStart), int(spanEnd)))
+		try:
+			for row in cursor:
+				yield row
+		finally:
+			# The next month's shards cannot be attached while it is open.
+			cursor.close()
+
+# Queries for Totals of each count, from the rollups and from the raw
+# results. Errors are selected by a case expression mapping each error type
+# counted to its column index, and a list of those types.
+storeQueries = ("""
+SELECT "hour", 0, coalesce("GiB", 0) FROM "store_size_hourly" WHERE "hour" >= ?1 AND "hour" < ?2
+UNION ALL
+SELECT "hour", 1, "count" FROM "store_size_hourly" WHERE "hour" >= ?1 AND "hour" < ?2
+""", """
+SELECT "time", 0, "GiB" FROM "store_size" WHERE "time" >= ?1 AND "time" < ?2 AND "GiB" IS NOT NULL
+UNION ALL
+SELECT "time", 1, 1 FROM "store_size" WHERE "time" >= ?1 AND "time" < ?2 AND "GiB" IS NOT NULL
+""")
+
+refusedQueries = ("""
+SELECT "hour", 0, sum("count") FROM "refused_hourly" WHERE "hour" >= ?1 AND "hour" < ?2 GROUP BY "hour"
+""", """
+SELECT "time", 0, 1 FROM "refused" WHERE "time" >= ?1 AND "time" < ?2
+""")
+
+errorQueries = ("""
+SELECT "hour", case "error_type" {0} end, sum("count") FROM "error_hourly"
+WHERE "hour" >= ?1 AND "hour" < ?2 AND "error_type" IN ({1})
+GROUP BY "hour", "error_type"
+""", """
+SELECT "time", case "error_type" {0} end, 1 FROM "error"
+WHERE "time" >= ?1 AND "time" < ?2 AND "error_type" IN ({1})
+""")
+
+def read_hours(task):
+	"""
+	Returns the results for a sequence of increasing period ends. Runs in
+	worker processes, so it takes a single tuple of arguments: the database
+	file, whether to read its monthly shards, the period ends as datetimes,
+	the short, medium, and long periods as timedeltas, and the codes of the
+	error types to count.
+	"""
+	databaseFile, shards, ends, shortPeriod, mediumPeriod, longPeriod, errorCodes = task
+	if not ends:
+		return None
+
+	db = ShardRouter(databaseFile) if shards else connect_reader(databaseFile)
+
+	shortLength, mediumLength, longLength = [ int(totalSeconds(period)) for period in [ shortPeriod, mediumPeriod, longPeriod ] ]
+	results = { "end": np.array([ toPosix(end) for end in ends ], dtype=np.int64) }
+	end = results["end"]
+
+	rows = select(db, identifierStreamQuery, end[0] - 2*longLength, end[-1] + 1)
+	estimator = SizeEstimator(rows, shortLength, mediumLength, longLength)
+	samples = np.array([ estimator.advance(int(time)) for time in end ]).reshape(-1, 3, 2)
+	# The estimator may not have read to the end.
+	rows.close()
+	results["instantaneous"], results["daily"], results["weekly"] = samples[:, 0], samples[:, 1], samples[:, 2]
+
+	# Counts are read once for the whole range. The rollups only hold whole
+	# hours, so use them only if every period starts and ends on the hour.
+	# The hours before an end on the hour are complete, as it is in the past.
+	raw = bool(np.any(end % 3600) or shortLength % 3600 or longLength % 3600)
+
+	# Past week of datastore sizes.
+	stores = Totals(select(db, storeQueries[raw], end[0] - longLength, end[-1]), 2).between(end - longLength, end)
+	results["storeGiB"], results["storeCount"] = stores[:, 0], stores[:, 1]
+
+	results["refused"] = Totals(select(db, refusedQueries[raw], end[0] - shortLength, end[-1]), 1).between(end - shortLength, end)[:, 0]
+
+	# Get numbers of each error type. Types not counted are left out.
+	columns = string.join([ "when {0} then {1}".format(int(code), index) for index, code in enumerate(errorCodes) ], " ")
+	results["errors"] = Totals(select(db, errorQueries[raw].format(columns, string.join([ str(int(code)) for code in errorCodes ], ", ")),
+	                                  end[0] - shortLength, end[-1]), len(errorCodes)).between(end - shortLength, end)
+
+	db.close()
+	return results
+
+def split(ends, chunks):
+	"""
+	Splits a list into the given number of contiguous chunks of nearly equal
+	length.
+	"""
+	size, extra = divmod(len(ends), chunks)
+	bounds = [ index * size + min(index, extra) for index in range(chunks + 1) ]
+	return [ ends[bounds[index]:bounds[index + 1]] for index in range(chunks) ]
+
+def read(databaseFile, shards, ends, shortPeriod, mediumPeriod, longPeriod, errorCodes, jobs=1):
+	"""
+	Returns the results for a list of increasing period ends, read by the
+	given number of processes. Each reads the identifier results in the long
+	periods before its chunk as well as in it, so chunks much shorter than
+	two long periods save little.
+	"""
+	chunks = max(1, min(jobs, len(ends)))
+	tasks = [ (databaseFile, shards, chunk, shortPeriod, mediumPeriod, longPeriod, errorCodes) for chunk in split(ends, chunks) ]
+
+	if chunks == 1:
+		results = map(read_hours, tasks)
+	else:
+		pool = multiprocessing.Pool(chunks)
+		try:
+			results = pool.map(read_hours, tasks)
+		finally:
+			pool.close()
+			pool.join()
+
+	results = filter(None, results)
+	if not results:
+		return None
+	return dict((key, np.concatenate([ chunk[key] for chunk in results ])) for key in keys)
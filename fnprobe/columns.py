@@ -0,0 +1,209 @@
+import os
+import numpy as np
+from fnprobe.db import unpack_lengths
+
+# Results can be exported to a directory holding a directory per table with a
+# .npy file per column, so that analysis can memory-map them instead of
+# fetching rows from the database one at a time. Exports are incremental:
+# each only appends the rows with rowids after the last one exported. Integer
+# columns store NULL as -1, and float columns as NaN.
+
+# Size of the header of each column file. It is padded so that the shape can
+# be rewritten in place as rows are appended.
+headerSize = 128
+
+# Columns exported from every table: (name, SQL expression, dtype)
+commonColumns = [ ("rowid", """rowid""", "<i8"),
+                  ("time", """coalesce("time", -1)""", "<i8"),
+                  ("htl", """coalesce("htl", -1)""", "<i8"),
+                  ("duration", """"duration" """, "<f8"),
+                  ("node", """coalesce("node", -1)""", "<i8") ]
+
+tableColumns = {
+	"bandwidth": [ ("KiB", """"KiB" """, "<f8") ],
+	"build": [ ("build", """coalesce("build", -1)""", "<i8") ],
+	"identifier": [ ("identifier", """coalesce("identifier", -1)""", "<i8"),
+	                ("percent", """coalesce("percent", -1)""", "<i8") ],
+	# The link lengths of all rows are concatenated in lengths.npy, which is
+	# not a column; lengths_count is the number each row has.
+	"peer_count": [ ("peers", """coalesce("peers", -1)""", "<i8"),
+	                ("lengths_count", """coalesce(length("lengths") / 8, 0)""", "<i8") ],
+	"location": [ ("location", """"location" """, "<f8") ],
+	"store_size": [ ("GiB", """"GiB" """, "<f8") ],
+	"uptime_48h": [ ("percent", """"percent" """, "<f8") ],
+	"uptime_7d": [ ("percent", """"percent" """, "<f8") ],
+	# local is 1 for local errors, 0 for remote ones, and -1 if unknown.
+	"error": [ ("probe_type", """coalesce("probe_type", -1)""", "<i8"),
+	           ("error_type", """coalesce("error_type", -1)""", "<i8"),
+	           ("code", """coalesce("code", -1)""", "<i8"),
+	           ("local", """case "local" when 'true' then 1 when 'false' then 0 else -1 end""", "<i8") ],
+	"refused": [ ("probe_type", """coalesce("probe_type", -1)""", "<i8") ],
+}
+
+class ColumnFile(object):
+	"""
+	A one-dimensional .npy file which can be appended to. Appended values are
+	only part of the array once commit() rewrites the shape in the header;
+	any written after the last commit are discarded when it is opened again.
+	"""
+	def __init__(self, path, dtype):
+		self.path = path
+		self.dtype = np.dtype(dtype)
+		self.pending = 0
+
+		if not os.path.exists(path):
+			with open(path, 'wb') as output:
+				output.write(self.header(0))
+
+		self.file = open(path, 'r+b')
+		np.lib.format.read_magic(self.file)
+		shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(self.file)
+		if dtype != self.dtype:
+			raise ValueError("{0} holds {1}, not {2}.".format(path, dtype, self.dtype))
+		self.truncate(shape[0])
+
+	def header(self, length):
+		description = "{{'descr': '{0}', 'fortran_order': False, 'shape': ({1},), }}".format(self.dtype.str, length)
+		# Magic string, version 1.0, and the little-endian length of the rest.
+		prefix = "\x93NUMPY\x01\x00" + np.array(headerSize - 10, "<u2").tostring()
+		return prefix + description.ljust(headerSize - len(prefix) - 1) + "\n"
+
+	def truncate(self, length):
+		"""
+		Discard values after the first length.
+		"""
+		self.length = length
+		self.pending = 0
+		self.file.truncate(headerSize + length * self.dtype.itemsize)
+		self.file.seek(0)
+		self.file.write(self.header(length))
+		self.file.flush()
+
+	def last(self):
+		"""
+		Returns the last value, or None if there are none.
+		"""
+		if self.length == 0:
+			return None
+		self.file.seek(headerSize + (self.length - 1) * self.dtype.itemsize)
+		return np.fromstring(self.file.read(self.dtype.itemsize), self.dtype)[0]
+
+	def append(self, values):
+		self.file.seek(headerSize + (self.length + self.pending) * self.dtype.itemsize)
+		self.file.write(np.asarray(values).astype(self.dtype).tostring())
+		self.pending += len(values)
+
+	def commit(self):
+		"""
+		Make appended values part of the array.
+		"""
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.length += self.pending
+		self.pending = 0
+		self.file.seek(0)
+		self.file.write(self.header(self.length))
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+def export_table(db, directory, table, batchSize):
+	"""
+	Append the rows of the table added since the last export to its columns
+	in directory. Returns the number of rows appended.
+	"""
+	path = os.path.join(directory, table)
+	if not os.path.isdir(path):
+		os.makedirs(path)
+
+	columns = commonColumns + tableColumns[table]
+	files = [ ColumnFile(os.path.join(path, name + ".npy"), dtype) for name, expression, dtype in columns ]
+	lengths = ColumnFile(os.path.join(path, "lengths.npy"), "<f8") if table == "peer_count" else None
+
+	# An interrupted export may have committed some columns but not others.
+	# Discard the rows not in all of them.
+	length = min(columnFile.length for columnFile in files)
+	for columnFile in files:
+		columnFile.truncate(length)
+	if lengths is not None:
+		counts = np.load(os.path.join(path, "lengths_count.npy"), mmap_mode='r') if length else []
+		lengths.truncate(int(np.sum(counts[:length])))
+		del counts
+
+	position = files[0].last() or 0
+	cursor = db.execute("""select {0}{1} from "{2}" where rowid > ? order by rowid""".format(
+	                    ", ".join(expression for name, expression, dtype in columns),
+	                    ', "lengths"' if lengths is not None else "", table), (position,))
+
+	exported = 0
+	while True:
+		rows = cursor.fetchmany(batchSize)
+		if not rows:
+			break
+
+		for index, columnFile in enumerate(files):
+			# NULL floats become NaN.
+			columnFile.append(np.array([ row[index] for row in rows ], dtype=columnFile.dtype))
+		if lengths is not None:
+			lengths.append(np.frombuffer(unpack_lengths([ row[-1] for row in rows ]), "<f8"))
+			lengths.commit()
+		for columnFile in files:
+			columnFile.commit()
+		exported += len(rows)
+
+	for columnFile in files + filter(None, [ lengths ]):
+		columnFile.close()
+
+	return exported
+
+def export(db, directory, batchSize=100000):
+	"""
+	Append the rows added to each table since the last export to directory.
+	Returns a dictionary of the number of rows appended by table.
+	"""
+	return dict((table, export_table(db, directory, table, batchSize)) for table in sorted(tableColumns))
+
+def load(directory, table):
+	"""
+	Returns a dictionary of the exported columns of the table, in rowid order,
+	as read-only memory-mapped arrays. For peer_count, "lengths" holds the
+	link lengths of all rows; see lengths_of().
+	"""
+	path = os.path.join(directory, table)
+	columns = {}
+	for name, expression, dtype in commonColumns + tableColumns[table]:
+		columns[name] = mmap(os.path.join(path, name + ".npy"), dtype)
+
+	# Rows being appended may not be in every column yet.
+	length = min(len(column) for column in columns.values())
+	for name in columns:
+		columns[name] = columns[name][:length]
+
+	if table == "peer_count":
+		columns["lengths"] = mmap(os.path.join(path, "lengths.npy"), "<f8")[:int(np.sum(columns["lengths_count"]))]
+
+	return columns
+
+def mmap(path, dtype):
+	"""
+	Memory-map a column file, which cannot be done to an empty one.
+	"""
+	if not os.path.exists(path):
+		raise IOError("{0} has not been exported.".format(path))
+	if os.path.getsize(path) <= headerSize:
+		return np.zeros(0, dtype)
+	return np.load(path, mmap_mode='r')
+
+def window(columns, start, end):
+	"""
+	Returns a mask of the rows with times from the POSIX times start to end
+	inclusive, matching SQL BETWEEN.
+	"""
+	return (columns["time"] >= start) & (columns["time"] <= end)
+
+def lengths_of(columns, mask):
+	"""
+	Returns the link lengths of the peer_count rows selected by mask.
+	"""
+	return columns["lengths"][np.repeat(mask, columns["lengths_count"])]
@@ -0,0 +1,108 @@
+from __future__ import division
+import logging
+import math
+from twisted.internet.task import LoopingCall
+
+# Seconds between rate adjustments.
+adjustPeriod = 60
+
+# Probes/minute added to the rate after a period below the congestion threshold.
+additiveIncrease = 2
+
+# Factor the rate is multiplied by after a period above the congestion threshold.
+multiplicativeDecrease = 0.5
+
+# Weight of each new response time in the moving average.
+rttWeight = 0.1
+
+# Error types which indicate the network is being sent more than it can handle.
+congestionErrors = [ "OVERLOAD", "TIMEOUT" ]
+
+class AIMDController(object):
+	"""
+	Adjusts the probe send rate with additive increase, multiplicative decrease
+	based on the fraction of responses which were refusals or overload or
+	timeout errors during each adjustPeriod. The rate is kept between minRate
+	and maxRate probes/minute.
+
+	The maximum number of outstanding probes follows the rate: by Little's law
+	the expected number outstanding is the rate times the response time, and
+	twice that is allowed.
+
+	setPeriod is called with the new seconds/probe whenever the rate changes.
+	"""
+	def __init__(self, rate, minRate, maxRate, threshold, timeout, setPeriod):
+		self.minRate = minRate
+		self.maxRate = maxRate
+		self.rate = min(max(rate, minRate), maxRate)
+		self.threshold = threshold
+		self.timeout = timeout
+		self.setPeriod = setPeriod
+
+		# Moving average of response time. Start pessimistic.
+		self.rtt = timeout / 2
+
+		# Responses during the current adjustment period.
+		self.responses = 0
+		self.congested = 0
+
+		self.adjustLoop = LoopingCall(self.adjust)
+
+	def period(self):
+		"""
+		Seconds between probes at the current rate.
+		"""
+		return 60 / self.rate
+
+	def window(self):
+		"""
+		Maximum number of outstanding probes at the current rate.
+		"""
+		return max(1, int(math.ceil(2 * self.rate / 60 * self.rtt)))
+
+	def start(self):
+		if not self.adjustLoop.running:
+			self.adjustLoop.start(adjustPeriod, now=False)
+
+	def stop(self):
+		if self.adjustLoop.running:
+			self.adjustLoop.stop()
+
+	def canSend(self, outstanding):
+		return outstanding < self.window()
+
+	def received(self, message, duration):
+		self.responses += 1
+
+		if message.name == "ProbeRefused" or \
+		   (message.name == "ProbeError" and message["Type"] in congestionErrors):
+			self.congested += 1
+		else:
+			self.rtt += rttWeight * (duration - self.rtt)
+
+	def timedOut(self):
+		"""
+		A probe got no response before the timeout.
+		"""
+		self.responses += 1
+		self.congested += 1
+
+	def adjust(self):
+		if self.responses == 0:
+			return
+
+		ratio = self.congested / self.responses
+		previous = self.rate
+		if ratio > self.threshold:
+			self.rate = max(self.minRate, self.rate * multiplicativeDecrease)
+		else:
+			self.rate = min(self.maxRate, self.rate + additiveIncrease)
+
+		logging.info("{0:.1%} of {1} responses indicated congestion. Probe rate {2:.1f} -> {3:.1f}/minute; up to {4} outstanding."
+		             .format(ratio, self.responses, previous, self.rate, self.window()))
+
+		self.responses = 0
+		self.congested = 0
+
+		if self.rate != previous:
+			self.setPeriod(self.period())
@@ -1,18 +1,85 @@
+import datetime
+import glob
 import logging
+import os
+import sqlite3
+import sys
+from array import array
 from fnprobe.time import toPosix, timestamp
 from enum import Enum
 import string
 
-# TODO: Enums between names and codes
+# Probe and error types are stored as their index in these enums. Use the
+# encode_ and decode_ functions below to convert between names and codes.
 # http://pypi.python.org/pypi/enum/0.4.4
 # https://github.com/freenet/fred-official/blob/master/src/freenet/node/probe/Type.java
-# Then what... getarr?
 probeTypes = Enum('BANDWIDTH', 'BUILD', 'IDENTIFIER', 'LINK_LENGTHS',
                   'LOCATION', 'STORE_SIZE', 'UPTIME_48H', 'UPTIME_7D')
 
 errorTypes = Enum('DISCONNECTED', 'OVERLOAD', 'TIMEOUT', 'UNKNOWN',
                   'UNRECOGNIZED_TYPE', 'CANNOT_FORWARD')
 
+# Connection profiles. Writers use Write-Ahead Logging so that readers do not
+# block them, with synchronous=NORMAL: a commit is durable once the WAL is
+# synced at a checkpoint, and the database cannot be corrupted by a crash,
+# though the last transactions before a power loss may be rolled back.
+# Readers memory-map the database and cannot write to it. Both keep
+# temporary tables in memory and use a larger page cache than the 2 MB
+# default. The busy timeout is set by the timeout argument to connect.
+# See https://www.sqlite.org/pragma.html https://www.sqlite.org/wal.html
+# https://www.sqlite.org/mmap.html
+cacheKiB = 64 * 1024
+mmapBytes = 1024 * 1024 * 1024
+
+def configure_writer(db):
+	"""
+	Apply the writer profile to a connection. Also suitable as the cp_openfun
+	of an adbapi.ConnectionPool.
+	"""
+	journal_mode = db.execute("""PRAGMA journal_mode = WAL""").fetchone()[0]
+	if journal_mode != "wal":
+		logging.warning("Unable to change journal_mode to Write-Ahead Logging. It is currently '{0}'".format(journal_mode))
+	db.execute("""PRAGMA synchronous = NORMAL""")
+	db.execute("""PRAGMA cache_size = -{0}""".format(cacheKiB))
+	db.execute("""PRAGMA temp_store = MEMORY""")
+
+def configure_reader(db, schema="main"):
+	"""
+	Apply the reader profile to a connection, or to one of its attached
+	databases.
+	"""
+	db.execute("""PRAGMA "{0}".cache_size = -{1}""".format(schema, cacheKiB))
+	db.execute("""PRAGMA "{0}".mmap_size = {1}""".format(schema, mmapBytes))
+	db.execute("""PRAGMA temp_store = MEMORY""")
+
+def connect_writer(path, timeout=60):
+	"""
+	Open a connection to the database at path with the writer profile.
+	"""
+	db = sqlite3.connect(path, timeout=timeout)
+	configure_writer(db)
+	return db
+
+def connect_reader(path, timeout=60):
+	"""
+	Open a read-only connection to the existing database at path with the
+	reader profile.
+	"""
+	try:
+		# Only these characters have a special meaning in the path of an SQLite URI.
+		quoted = os.path.abspath(path).replace("%", "%25").replace("?", "%3f").replace("#", "%23")
+		uri = "file:{0}?mode=ro".format(quoted)
+		db = sqlite3.connect(uri, timeout=timeout, uri=True)
+	except TypeError:
+		# The sqlite3 module before Python 3.4 cannot open URIs. Refuse
+		# writes on the connection instead.
+		if not os.path.exists(path):
+			raise sqlite3.OperationalError("unable to open database file")
+		db = sqlite3.connect(path, timeout=timeout)
+		db.execute("""PRAGMA query_only = 1""")
+	configure_reader(db)
+	return db
+
 def init_database(db):
 	"""
 	Initialize the database if it does not already exist. If it already exists and
@@ -27,13 +94,19 @@ def init_database(db):
 
 def create_new(db):
 	logging.warning("Setting up new database.")
-	db.execute("PRAGMA user_version = 5")
+	# Free pages left by compaction can only be returned to the filesystem
+	# with incremental vacuum. Setting the journal mode already wrote the
+	# header, so vacuum the still empty database for this to take effect.
+	db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+	db.execute("vacuum")
+	db.execute("PRAGMA user_version = 11")
 
 	db.execute("""create table bandwidth(
 	                                     time     DATETIME,
 	                                     htl      INTEGER,
 	                                     KiB      FLOAT,
-	                                     duration FLOAT
+	                                     duration FLOAT,
+	                                     node     INTEGER
 	                                    )""")
 	db.execute("""create index bandwidth_time_index on bandwidth(time)""")
 
@@ -41,7 +114,8 @@ def create_new(db):
 	                                 time     DATETIME,
 	                                 htl      INTEGER,
 	                                 build    INTEGER,
-	                                 duration FLOAT
+	                                 duration FLOAT,
+	                                 node     INTEGER
 	                                )""")
 	db.execute("""create index build_time_index on build(time)""")
 
@@ -50,27 +124,21 @@ def create_new(db):
 	                                      htl        INTEGER,
 	                                      identifier INTEGER,
 	                                      percent    INTEGER,
-	                                      duration   FLOAT
+	                                      duration   FLOAT,
+	                                      node       INTEGER
 	                                     )""")
 	db.execute("""create index identifier_identifier_time on identifier(identifier, time)""")
 	db.execute("""create index identifier_time_identifier on identifier(time, identifier)""")
 
-	# link_lengths need not have duration because peer count will have it for
-	# all LINK_LENGTHS requests. Storing it on link_lengths would be needless
-	# duplication.
-	db.execute("""create table link_lengths(
-	                                        time   DATETIME,
-	                                        htl    INTEGER,
-	                                        length FLOAT,
-	                                        id     INTEGER
-	                                       )""")
-	db.execute("""create index link_lengths_time_index on link_lengths(time)""")
-
+	# The link lengths of each LINK_LENGTHS result are packed into a single
+	# blob. See pack_lengths().
 	db.execute("""create table peer_count(
 	                                      time     DATETIME,
 	                                      htl      INTEGER,
 	                                      peers    INTEGER,
-	                                      duration FLOAT
+	                                      duration FLOAT,
+	                                      node     INTEGER,
+	                                      lengths  BLOB
 	                                     )""")
 	db.execute("""create index peer_count_time_index on peer_count(time)""")
 
@@ -78,7 +146,8 @@ def create_new(db):
 	                                    time     DATETIME,
 	                                    htl      INTEGER,
 	                                    location FLOAT,
-	                                    duration FLOAT
+	                                    duration FLOAT,
+	                                    node     INTEGER
 	                                   )""")
 	db.execute("""create index location_time_index on location(time)""")
 
@@ -86,7 +155,8 @@ def create_new(db):
 	                                      time     DATETIME,
 	                                      htl      INTEGER,
 	                                      GiB      FLOAT,
-	                                      duration FLOAT
+	                                      duration FLOAT,
+	                                      node     INTEGER
 	                                     )""")
 	db.execute("""create index store_size_time_index on store_size(time)""")
 
@@ -94,7 +164,8 @@ def create_new(db):
 	                                      time     DATETIME,
 	                                      htl      INTEGER,
 	                                      percent  FLOAT,
-	                                      duration FLOAT
+	                                      duration FLOAT,
+	                                      node     INTEGER
 	                                     )""")
 	db.execute("""create index uptime_48h_time_index on uptime_48h(time)""")
 
@@ -102,7 +173,8 @@ def create_new(db):
 	                                     time     DATETIME,
 	                                     htl      INTEGER,
 	                                     percent  FLOAT,
-	                                     duration FLOAT
+	                                     duration FLOAT,
+	                                     node     INTEGER
 	                                    )""")
 	db.execute("""create index uptime_7d_time_index on uptime_7d(time)""")
 
@@ -115,20 +187,121 @@ def create_new(db):
 	                                 error_type INTEGER,
 	                                 code       INTEGER,
 	                                 duration   FLOAT,
-	                                 local      BOOLEAN
+	                                 local      BOOLEAN,
+	                                 node       INTEGER
 	                                )""")
 	db.execute("""create index error_time_index on error(time)""")
+	db.execute("""create index error_probe_type_time on error(probe_type, time)""")
+	db.execute("""create index error_error_type_time on error(error_type, time)""")
 
 	db.execute("""create table refused(
 	                                   time       DATETIME,
 	                                   htl        INTEGER,
 	                                   probe_type INTEGER,
-	                                   duration   FLOAT
+	                                   duration   FLOAT,
+	                                   node       INTEGER
 	                                  )""")
 	db.execute("""create index refused_time_index on refused(time)""")
+	db.execute("""create index refused_probe_type_time on refused(probe_type, time)""")
+
+	# Probe results are stored with the node which made the request.
+	db.execute("""create table node(
+	                                id   INTEGER PRIMARY KEY,
+	                                name TEXT UNIQUE
+	                               )""")
+
+	create_rollups(db)
+	create_migration(db)
+	create_compaction(db)
+	create_presence(db)
 
 	db.execute("analyze")
 
+def create_migration(db):
+	"""
+	Create the table of backfills in progress. See backfill_step().
+	"""
+	db.execute("""create table migration(
+	                                     id       INTEGER PRIMARY KEY,
+	                                     name     TEXT UNIQUE,
+	                                     position INTEGER,
+	                                     target   INTEGER
+	                                    )""")
+
+def create_rollups(db):
+	"""
+	Create the hourly rollup tables. Each row summarizes results in the hour
+	starting at the POSIX time "hour". They are kept up to date as results
+	are inserted; see rollup_error(), rollup_refused(), and rollup_store_size().
+	"""
+	# local is 1 for local errors, 0 for remote ones, and NULL if unknown.
+	db.execute("""create table error_hourly(
+	                                        hour       INTEGER,
+	                                        probe_type INTEGER,
+	                                        error_type INTEGER,
+	                                        local      INTEGER,
+	                                        count      INTEGER,
+	                                        PRIMARY KEY(hour, probe_type, error_type, local)
+	                                       )""")
+
+	db.execute("""create table refused_hourly(
+	                                          hour       INTEGER,
+	                                          probe_type INTEGER,
+	                                          count      INTEGER,
+	                                          PRIMARY KEY(hour, probe_type)
+	                                         )""")
+
+	db.execute("""create table store_size_hourly(
+	                                             hour  INTEGER PRIMARY KEY,
+	                                             GiB   FLOAT,
+	                                             count INTEGER
+	                                            )""")
+
+def create_compaction(db):
+	"""
+	Create the tables raw results are compacted into once they are older than
+	their retention. See compact_step().
+	"""
+	# Count of results of a table with each bucket value by hour. The bucket
+	# of each table is given by histogramBuckets.
+	db.execute("""create table histogram(
+	                                     source TEXT,
+	                                     hour   INTEGER,
+	                                     bucket,
+	                                     count  INTEGER,
+	                                     PRIMARY KEY(source, hour, bucket)
+	                                    )""")
+
+	# The identifiers seen each hour with the number of times each was seen,
+	# which is enough to estimate size over whole hours.
+	db.execute("""create table identifier_hourly(
+	                                             hour       INTEGER,
+	                                             identifier INTEGER,
+	                                             count      INTEGER,
+	                                             PRIMARY KEY(hour, identifier)
+	                                            )""")
+
+	# Results of the source table before the POSIX time cutoff were compacted.
+	db.execute("""create table compaction(
+	                                      source TEXT PRIMARY KEY,
+	                                      cutoff INTEGER
+	                                     )""")
+
+def create_presence(db):
+	"""
+	Create the table of the hours in which each identifier was seen. See
+	mark_present().
+	"""
+	# Bit i of bits is set if the identifier was seen in hour i of the block,
+	# counting hours from the epoch in blocks of presenceBlockHours. Bits are
+	# most significant first, as from numpy.packbits().
+	db.execute("""create table identifier_presence(
+	                                               block      INTEGER,
+	                                               identifier INTEGER,
+	                                               bits       BLOB,
+	                                               PRIMARY KEY(block, identifier)
+	                                              )""")
+
 def createVersion4(db):
 	"""
 	Create a version 4 database. This is separated to avoid duplication between
@@ -380,4 +553,695 @@ def upgrade(db):
 		version = update_version(5)
 		logging.warning("Update from 4 to 5 complete.")
 
+	# In version 6: Record which node made the request for each result, so that
+	# results from multiple nodes probing at once can be told apart. Existing
+	# results have no node.
+	if version == 5:
+		logging.warning("Upgrading from database version 5 to version 6.")
+
+		db.execute("""create table node(
+		                                id   INTEGER PRIMARY KEY,
+		                                name TEXT UNIQUE
+		                               )""")
+
+		for table in [ "bandwidth", "build", "identifier", "link_lengths", "peer_count",
+		               "location", "store_size", "uptime_48h", "uptime_7d", "error", "refused" ]:
+			db.execute("""alter table "{0}" add column node INTEGER""".format(table))
+
+		version = update_version(6)
+		logging.warning("Update from 5 to 6 complete.")
+
+	# In version 7: Store the link lengths of each result as a packed array on
+	# its peer_count row instead of as one link_lengths row per length, each
+	# repeating the time and HTL. link_lengths.id is the peer_count rowid.
+	# Existing lengths are packed in the background, after which link_lengths
+	# is dropped. Vacuum afterward to reclaim its space.
+	if version == 6:
+		logging.warning("Upgrading from database version 6 to version 7.")
+
+		create_migration(db)
+		db.execute("""alter table peer_count add column lengths BLOB""")
+		schedule_backfill(db, "link_lengths", "link_lengths")
+
+		version = update_version(7)
+		logging.warning("Update from 6 to 7 complete. Existing link lengths will be packed in the background.")
+
+	# In version 8: Store probe and error types as integer codes. Version 4
+	# converted existing names, but results since were still stored as names.
+	# They are converted in the background. Add indexes for counting errors and
+	# refusals by type over time.
+	if version == 7:
+		logging.warning("Upgrading from database version 7 to version 8.")
+
+		schedule_backfill(db, "error_types", "error")
+		schedule_backfill(db, "refused_types", "refused")
+
+		db.execute("""create index error_probe_type_time on error(probe_type, time)""")
+		db.execute("""create index error_error_type_time on error(error_type, time)""")
+		db.execute("""create index refused_probe_type_time on refused(probe_type, time)""")
+
+		version = update_version(8)
+		logging.warning("Update from 7 to 8 complete. Existing types will be converted in the background.")
+
+	# In version 9: Add hourly rollups of errors, refusals, and store sizes so
+	# that analysis over time does not have to scan the raw tables. Existing
+	# results are added to them in the background, after type conversion.
+	if version == 8:
+		logging.warning("Upgrading from database version 8 to version 9.")
+
+		create_rollups(db)
+		schedule_backfill(db, "error_hourly", "error")
+		schedule_backfill(db, "refused_hourly", "refused")
+		schedule_backfill(db, "store_size_hourly", "store_size")
+
+		version = update_version(9)
+		logging.warning("Update from 8 to 9 complete. Existing results will be added to the rollups in the background.")
+
+	# In version 10: Add tables to compact results older than their retention
+	# into. See compact.py. New databases use incremental auto-vacuum to return
+	# the space freed by compaction; existing ones must be vacuumed once to
+	# switch to it, which compact.py --enable-incremental-vacuum does.
+	if version == 9:
+		logging.warning("Upgrading from database version 9 to version 10.")
+
+		create_compaction(db)
+
+		version = update_version(10)
+		logging.warning("Update from 9 to 10 complete.")
+
+	# In version 11: Record the hours in which each identifier was seen as a
+	# bitmap, so that estimators can read which identifiers were seen when
+	# without joining the identifier table with itself. Existing identifiers,
+	# including compacted ones, are added in the background.
+	if version == 10:
+		logging.warning("Upgrading from database version 10 to version 11.")
+
+		create_presence(db)
+		schedule_backfill(db, "identifier_presence", "identifier")
+		schedule_backfill(db, "identifier_presence_hourly", "identifier_hourly")
+
+		version = update_version(11)
+		logging.warning("Update from 10 to 11 complete. Existing identifiers will be added to the presence bitmap in the background.")
+
+def encode_probe_type(name):
+	"""
+	Returns the code stored for the probe type with the given name.
+	"""
+	return getattr(probeTypes, name).index
+
+def decode_probe_type(code):
+	"""
+	Returns the name of the probe type stored as the given code.
+	"""
+	if code is None:
+		return None
+	return str(probeTypes[code])
+
+def encode_error_type(name):
+	"""
+	Returns the code stored for the error type with the given name. Error types
+	added to the node after this was written are stored as UNKNOWN.
+	"""
+	if not hasattr(errorTypes, name):
+		logging.warning("Storing unrecognized error type '{0}' as UNKNOWN.".format(name))
+		name = "UNKNOWN"
+	return getattr(errorTypes, name).index
+
+def decode_error_type(code):
+	"""
+	Returns the name of the error type stored as the given code.
+	"""
+	if code is None:
+		return None
+	return str(errorTypes[code])
+
+def hour_start(time):
+	"""
+	Returns the POSIX time of the start of the hour containing a POSIX time.
+	"""
+	return int(time) - int(time) % 3600
+
+# SQL expression for the start of the hour of a result.
+hourOf = """cast("time" as integer) / 3600 * 3600"""
+
+def add_to_rollup(db, table, key, totals):
+	"""
+	Adds to the totals of the row of a rollup table with the given key, creating
+	it if needed. key and totals are lists of (column, value) pairs.
+	"""
+	# NULL is never equal to anything, so match it with "is". For the same
+	# reason a NULL in the key never conflicts with an existing row, so insert
+	# only if nothing was updated rather than relying on "insert or ignore".
+	if db.execute("""update "{0}" set {1} where {2}""".format(table,
+	              string.join([ '"{0}" = "{0}" + ?'.format(column) for column, value in totals ], ", "),
+	              string.join([ '"{0}" {1} ?'.format(column, "is" if value is None else "==") for column, value in key ], " and ")),
+	              [ value for column, value in totals ] + [ value for column, value in key ]).rowcount:
+		return
+
+	columns = [ column for column, value in key + totals ]
+	db.execute("""insert into "{0}"({1}) values({2})""".format(table,
+	           string.join([ '"{0}"'.format(column) for column in columns ], ", "),
+	           string.join([ "?" ] * len(columns), ", ")),
+	           [ value for column, value in key + totals ])
+
+def rollup_error(db, time, probe_type, error_type, local):
+	"""
+	Counts an error in its hourly rollup. probe_type and error_type are codes;
+	local is 'true' or 'false' as sent by the node.
+	"""
+	add_to_rollup(db, "error_hourly", [ ("hour", hour_start(time)), ("probe_type", probe_type), ("error_type", error_type),
+	                                    ("local", { 'true': 1, 'false': 0 }.get(local)) ], [ ("count", 1) ])
+
+def rollup_refused(db, time, probe_type):
+	"""
+	Counts a refusal in its hourly rollup. probe_type is a code.
+	"""
+	add_to_rollup(db, "refused_hourly", [ ("hour", hour_start(time)), ("probe_type", probe_type) ], [ ("count", 1) ])
+
+def rollup_store_size(db, time, GiB):
+	"""
+	Adds a store size to its hourly rollup.
+	"""
+	add_to_rollup(db, "store_size_hourly", [ ("hour", hour_start(time)) ], [ ("GiB", GiB), ("count", 1) ])
+
+def rebuild_rollups(db, since=0):
+	"""
+	Recompute the hourly rollups from the raw tables for hours starting at or
+	after the POSIX time since. This catches up after results are inserted
+	without going through the rollup_ functions. Hours whose results were
+	compacted away are kept as they are.
+	"""
+	def start(table):
+		return hour_start(max(since, compacted_before(db, table)))
+
+	db.execute("""delete from error_hourly where hour >= ?""", (start("error"),))
+	db.execute("""insert into error_hourly(hour, probe_type, error_type, local, count)
+	              select {0}, probe_type, error_type,
+	                     case local when 'true' then 1 when 'false' then 0 end, count(*)
+	              from error where "time" >= ? group by 1, 2, 3, 4""".format(hourOf), (start("error"),))
+
+	db.execute("""delete from refused_hourly where hour >= ?""", (start("refused"),))
+	db.execute("""insert into refused_hourly(hour, probe_type, count)
+	              select {0}, probe_type, count(*)
+	              from refused where "time" >= ? group by 1, 2""".format(hourOf), (start("refused"),))
+
+	db.execute("""delete from store_size_hourly where hour >= ?""", (start("store_size"),))
+	db.execute("""insert into store_size_hourly(hour, GiB, count)
+	              select {0}, sum(GiB), count(GiB)
+	              from store_size where "time" >= ? group by 1""".format(hourOf), (start("store_size"),))
+
+# Backfills move existing data into a new schema a batch at a time after an
+# upgrade, while new results are already written in the new schema. Each has
+# a row in the migration table with the rowid of the last row of its table
+# handled (position) and the last rowid present when it was scheduled (target).
+# A batch and the update of its position commit together, so a backfill
+# resumes where it left off after being interrupted. Backfills run one at a
+# time in the order they were scheduled.
+
+def schedule_backfill(db, name, table):
+	"""
+	Schedule the named backfill over the rows currently in table.
+	"""
+	end = db.execute("""select max(rowid) from "{0}" """.format(table)).fetchone()[0] or 0
+	db.execute("""insert or replace into migration(name, position, target) values(?, 0, ?)""", (name, end))
+
+def backfill_step(db, batchSize):
+	"""
+	Run one batch of about batchSize rows of the earliest scheduled backfill.
+	Returns False once there are none left.
+	"""
+	row = db.execute("""select name, position, target from migration order by id limit 1""").fetchone()
+	if row is None:
+		return False
+
+	name, position, end = row
+	position = backfills[name](db, position, min(position + batchSize, end), end)
+
+	if position >= end:
+		db.execute("""delete from migration where name == ?""", (name,))
+		logging.warning("Finished backfill {0}.".format(name))
+	else:
+		db.execute("""update migration set position = ? where name == ?""", (position, name))
+		logging.info("Backfill {0} at row {1} of {2}.".format(name, position, end))
+
+	return True
+
+# Each backfill handles the rows with rowids after start through stop, and
+# returns the rowid of the last row it handled.
+
+def backfill_link_lengths(db, start, stop, end):
+	# Dropping the table commits, so it may be gone if interrupted after that.
+	if db.execute("""select count(*) from sqlite_master where type == 'table' and name == 'link_lengths'""").fetchone()[0] == 0:
+		return end
+
+	# The lengths of a result are in consecutive rows. Finish the result the
+	# last row belongs to so that no result is split between batches.
+	cursor = db.execute("""select rowid, "id", "length" from "link_lengths" where rowid > ? and rowid <= ? order by rowid""", (start, end))
+	position, current, lengths = start, None, []
+	for rowid, peerCount, length in cursor:
+		if peerCount != current and lengths:
+			db.execute("""update peer_count set lengths = ? where rowid == ?""", (pack_lengths(lengths), current))
+			lengths = []
+			if position >= stop:
+				break
+		current = peerCount
+		lengths.append(length)
+		position = rowid
+	else:
+		if lengths:
+			db.execute("""update peer_count set lengths = ? where rowid == ?""", (pack_lengths(lengths), current))
+		position = end
+	cursor.close()
+
+	if position >= end:
+		db.execute("""drop table link_lengths""")
+
+	return position
+
+def type_codes(column, types):
+	"""
+	Returns an SQL expression for the code of a column holding type names or codes.
+	"""
+	cases = string.join([ "when '{0}' then {1}".format(value, value.index) for value in types ], " ")
+	return """case "{0}" {1} else "{0}" end""".format(column, cases)
+
+def backfill_error_types(db, start, stop, end):
+	db.execute("""update error set probe_type = {0}, error_type = {1} where rowid > ? and rowid <= ?""".format(
+	           type_codes("probe_type", probeTypes), type_codes("error_type", errorTypes)), (start, stop))
+	return stop
+
+def backfill_refused_types(db, start, stop, end):
+	db.execute("""update refused set probe_type = {0} where rowid > ? and rowid <= ?""".format(
+	           type_codes("probe_type", probeTypes)), (start, stop))
+	return stop
+
+# Results inserted since the upgrade are already in the rollups, so only
+# earlier ones are added.
+
+def backfill_error_hourly(db, start, stop, end):
+	for hour, probe_type, error_type, local, count in db.execute("""
+	    select {0}, probe_type, error_type, case local when 'true' then 1 when 'false' then 0 end, count(*)
+	    from error where rowid > ? and rowid <= ? group by 1, 2, 3, 4""".format(hourOf), (start, stop)).fetchall():
+		add_to_rollup(db, "error_hourly", [ ("hour", hour), ("probe_type", probe_type), ("error_type", error_type), ("local", local) ],
+		              [ ("count", count) ])
+	return stop
+
+def backfill_refused_hourly(db, start, stop, end):
+	for hour, probe_type, count in db.execute("""
+	    select {0}, probe_type, count(*)
+	    from refused where rowid > ? and rowid <= ? group by 1, 2""".format(hourOf), (start, stop)).fetchall():
+		add_to_rollup(db, "refused_hourly", [ ("hour", hour), ("probe_type", probe_type) ], [ ("count", count) ])
+	return stop
+
+def backfill_store_size_hourly(db, start, stop, end):
+	for hour, GiB, count in db.execute("""
+	    select {0}, sum(GiB), count(GiB)
+	    from store_size where rowid > ? and rowid <= ? group by 1""".format(hourOf), (start, stop)).fetchall():
+		add_to_rollup(db, "store_size_hourly", [ ("hour", hour) ], [ ("GiB", GiB), ("count", count) ])
+	return stop
+
+def backfill_identifier_presence(db, start, stop, end):
+	present = {}
+	for identifier, hour in db.execute("""
+	    select distinct identifier, {0} from identifier where rowid > ? and rowid <= ?""".format(hourOf), (start, stop)):
+		present.setdefault(identifier, []).append(hour)
+	for identifier, hours in present.items():
+		mark_present(db, identifier, hours)
+	return stop
+
+def backfill_identifier_presence_hourly(db, start, stop, end):
+	present = {}
+	for identifier, hour in db.execute("""
+	    select identifier, hour from identifier_hourly where rowid > ? and rowid <= ?""", (start, stop)):
+		present.setdefault(identifier, []).append(hour)
+	for identifier, hours in present.items():
+		mark_present(db, identifier, hours)
+	return stop
+
+backfills = {
+	"link_lengths": backfill_link_lengths,
+	"error_types": backfill_error_types,
+	"refused_types": backfill_refused_types,
+	"error_hourly": backfill_error_hourly,
+	"refused_hourly": backfill_refused_hourly,
+	"store_size_hourly": backfill_store_size_hourly,
+	"identifier_presence": backfill_identifier_presence,
+	"identifier_presence_hourly": backfill_identifier_presence_hourly,
+}
+
+# Compaction deletes the results of a table from before a cutoff, first adding
+# them to aggregates which take far less space: identifiers go to
+# identifier_hourly and the tables in histogramBuckets to histogram. Errors,
+# refusals, and store sizes are already in the hourly rollups. Like backfills
+# it works in batches which each commit with their aggregates, so that
+# probe.py can write in between and an interrupted compaction loses nothing.
+# The cutoff is rounded down to the start of an hour so that the aggregates
+# of an hour are complete once it is compacted.
+#
+# Link lengths have no aggregate, so peer_count is not compacted. The last
+# row of a table is never compacted: without it SQLite could give its rowid
+# to the next row inserted, and exports and backfills track their position
+# by rowid.
+
+# SQL expressions for the histogram bucket of a result of each table.
+histogramBuckets = {
+	"bandwidth": """cast("KiB" as integer)""",
+	"build": """"build" """,
+	"location": """round("location", 2)""",
+	"uptime_48h": """cast("percent" as integer)""",
+	"uptime_7d": """cast("percent" as integer)""",
+}
+
+compactableTables = [ "bandwidth", "build", "identifier", "location", "store_size",
+                      "uptime_48h", "uptime_7d", "error", "refused" ]
+
+def compacted_before(db, table):
+	"""
+	Returns the POSIX time before which results of the table were compacted,
+	or 0 if none were.
+	"""
+	row = db.execute("""select cutoff from compaction where source == ?""", (table,)).fetchone()
+	return row[0] if row else 0
+
+def count_results(db, table):
+	"""
+	Returns the number of results of a table of successes, including those
+	compacted away. Those are counted from what they were compacted into, so
+	that the count covers the same results as the hourly rollups.
+	"""
+	count = db.execute("""select count(*) from "{0}" """.format(table)).fetchone()[0]
+	if table == "identifier":
+		count += db.execute("""select coalesce(sum("count"), 0) from identifier_hourly""").fetchone()[0]
+	elif table == "store_size":
+		# Store sizes are only compacted into their rollup, which also counts
+		# those before the cutoff which are not deleted yet.
+		cutoff = compacted_before(db, table)
+		count = db.execute("""select count(*) from store_size where "time" >= ?""", (cutoff,)).fetchone()[0] + \
+		        db.execute("""select coalesce(sum("count"), 0) from store_size_hourly where hour < ?""", (cutoff,)).fetchone()[0]
+	else:
+		# Including any peer_count results, which were once compacted too.
+		count += db.execute("""select coalesce(sum("count"), 0) from histogram where source == ?""", (table,)).fetchone()[0]
+	return count
+
+def compact_step(db, table, cutoff, batchSize):
+	"""
+	Compact up to batchSize of the oldest results of the table from before
+	the POSIX time cutoff, and commit. Returns the number of results compacted,
+	which is less than batchSize once none are left.
+	"""
+	cutoff = hour_start(cutoff)
+	batch = """select rowid from "{0}" where "time" < ? and rowid < (select max(rowid) from "{0}") order by "time" limit ?""".format(table)
+
+	# Take the write lock before selecting the batch so that it cannot change
+	# before it is deleted.
+	db.execute("""begin immediate""")
+	try:
+		# Record the cutoff with the first batch, so that if interrupted the
+		# hours already partly compacted are kept by rebuild_rollups().
+		if cutoff > compacted_before(db, table):
+			db.execute("""insert or replace into compaction(source, cutoff) values(?, ?)""", (table, cutoff))
+
+		if table == "identifier":
+			for hour, identifier, count in db.execute("""
+			    select {0}, identifier, count(*) from identifier where rowid in ({1})
+			    group by 1, 2""".format(hourOf, batch), (cutoff, batchSize)).fetchall():
+				add_to_rollup(db, "identifier_hourly", [ ("hour", hour), ("identifier", identifier) ], [ ("count", count) ])
+		elif table in histogramBuckets:
+			for hour, bucket, count in db.execute("""
+			    select {0}, {1}, count(*) from "{2}" where rowid in ({3})
+			    group by 1, 2""".format(hourOf, histogramBuckets[table], table, batch), (cutoff, batchSize)).fetchall():
+				add_to_rollup(db, "histogram", [ ("source", table), ("hour", hour), ("bucket", bucket) ], [ ("count", count) ])
+
+		compacted = db.execute("""delete from "{0}" where rowid in ({1})""".format(table, batch), (cutoff, batchSize)).rowcount
+		db.commit()
+	except:
+		db.rollback()
+		raise
+
+	return compacted
+
+def incremental_vacuum(db, pages):
+	"""
+	Return up to the given number of free pages to the filesystem. Returns
+	the number of free pages left. Does nothing unless the database uses
+	incremental auto-vacuum.
+	"""
+	# Each step of the statement frees one page.
+	db.execute("""PRAGMA incremental_vacuum({0:d})""".format(pages)).fetchall()
+	db.commit()
+	return db.execute("""PRAGMA freelist_count""").fetchone()[0]
+
+# Hours in each identifier_presence row. A multiple of 8.
+presenceBlockHours = 256
+
+def mark_present(db, identifier, hours):
+	"""
+	Record that the identifier was seen in the hours containing the given
+	POSIX times.
+	"""
+	blocks = {}
+	for hour in hours:
+		block, offset = divmod(int(hour) // 3600, presenceBlockHours)
+		blocks.setdefault(block, []).append(offset)
+
+	for block, offsets in blocks.items():
+		row = db.execute("""select bits from identifier_presence where block == ? and identifier == ?""", (block, identifier)).fetchone()
+		bits = bytearray(row[0]) if row else bytearray(presenceBlockHours // 8)
+		before = bytearray(bits)
+		for offset in offsets:
+			bits[offset // 8] |= 0x80 >> (offset % 8)
+		if row is None or bits != before:
+			db.execute("""insert or replace into identifier_presence(block, identifier, bits) values(?, ?, ?)""",
+			           (block, identifier, buffer(bits)))
+
+def presence_matrix(db, start, end, chunkSize=65536):
+	"""
+	Returns which identifiers were seen in the hours from the one containing
+	the POSIX time start up to the POSIX time end. The result is a sorted
+	array of the identifiers seen and a bit-packed matrix with a row for each
+	of them and a bit for each hour, as from numpy.packbits(..., axis=1).
+	"""
+	# Imported here so that probe.py does not need NumPy.
+	import numpy as np
+
+	first = hour_start(start) // 3600
+	hours = max(0, -(-(int(end) - first * 3600) // 3600))
+	rowBytes = -(-hours // 8)
+	if hours == 0:
+		return np.zeros(0, np.int64), np.zeros((0, 0), np.uint8)
+
+	firstBlock = first // presenceBlockHours
+	blockCount = (first + hours - 1) // presenceBlockHours - firstBlock + 1
+	blockBytes = presenceBlockHours // 8
+
+	rows = db.execute("""select identifier, block, bits from identifier_presence where block >= ? and block < ?""",
+	                  (firstBlock, firstBlock + blockCount)).fetchall()
+	if not rows:
+		return np.zeros(0, np.int64), np.zeros((0, rowBytes), np.uint8)
+
+	rowIdentifiers = np.array([ row[0] for row in rows ], np.int64)
+	rowBlocks = np.array([ row[1] for row in rows ], np.int64) - firstBlock
+	rowBits = np.frombuffer(string.join([ str(row[2]) for row in rows ], ''), np.uint8).reshape(len(rows), blockBytes)
+	del rows
+
+	identifiers, rowIndexes = np.unique(rowIdentifiers, return_inverse=True)
+
+	# Place the blocks of each identifier side by side, then cut out the
+	# requested hours a chunk of identifiers at a time to limit the memory
+	# used unpacking them. Shards can each have a row for the same block.
+	blocks = np.zeros((len(identifiers), blockCount, blockBytes), np.uint8)
+	np.bitwise_or.at(blocks, (rowIndexes, rowBlocks), rowBits)
+	blocks = blocks.reshape(len(identifiers), blockCount * blockBytes)
+
+	offset = first - firstBlock * presenceBlockHours
+	matrix = np.zeros((len(identifiers), rowBytes), np.uint8)
+	for chunk in range(0, len(identifiers), chunkSize):
+		unpacked = np.unpackbits(blocks[chunk:chunk + chunkSize], axis=1)[:, offset:offset + hours]
+		matrix[chunk:chunk + chunkSize] = np.packbits(unpacked, axis=1)
+
+	# Drop identifiers only seen outside the hours requested.
+	seen = matrix.any(axis=1)
+	return identifiers[seen], matrix[seen]
+
+def pack_lengths(lengths):
+	"""
+	Packs link lengths into a blob of little-endian doubles. Empty lengths, as
+	from a node without peers, are skipped.
+	"""
+	packed = array('d', [ float(length) for length in lengths if length != '' ])
+	if sys.byteorder == 'big':
+		packed.byteswap()
+	return buffer(packed.tostring())
+
+def unpack_lengths(blobs):
+	"""
+	Unpacks the link lengths from a sequence of packed blobs into one array.
+	"""
+	lengths = array('d')
+	lengths.fromstring(string.join([ str(blob) for blob in blobs if blob is not None ], ''))
+	if sys.byteorder == 'big':
+		lengths.byteswap()
+	return lengths
+
+# Node IDs by connection and node name. Only valid while the rows adding
+# them are committed; see forget_node_ids().
+nodeIds = {}
+
+def node_id(db, name):
+	"""
+	Returns the ID of the node with the given name, adding it if needed.
+	"""
+	key = (db, name)
+	if key not in nodeIds:
+		row = db.execute("""select id from node where name == ?""", (name,)).fetchone()
+		if row is None:
+			row = (db.execute("""insert into node(name) values(?)""", (name,)).lastrowid,)
+		nodeIds[key] = row[0]
+
+	return nodeIds[key]
+
+def forget_node_ids(db):
+	"""
+	Forget the node IDs cached for a connection. Call after rolling back, which
+	may have undone adding a node, so that its ID is not used again.
+	"""
+	for key in [ key for key in nodeIds if key[0] is db ]:
+		del nodeIds[key]
+
+# With shardByMonth, results are written to a separate database file for each
+# UTC month, named after the database file with the month appended; for
+# instance database-2013-05.sql. Only the shard for the current month is
+# written to.
+
+def shard_month(time):
+	"""
+	Returns the month, as YYYY-MM, of the shard holding the given POSIX time.
+	"""
+	return datetime.datetime.utcfromtimestamp(time).strftime("%Y-%m")
+
+def shard_path(databaseFile, month):
+	"""
+	Returns the path of the shard of databaseFile for a YYYY-MM month.
+	"""
+	root, extension = os.path.splitext(databaseFile)
+	return "{0}-{1}{2}".format(root, month, extension)
+
+def next_month(month):
+	"""
+	Returns the YYYY-MM month after a YYYY-MM month.
+	"""
+	year, month = map(int, string.split(month, "-"))
+	year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+	return "{0:04d}-{1:02d}".format(year, month)
+
+def month_start(month):
+	"""
+	Returns the POSIX time a YYYY-MM month starts.
+	"""
+	year, month = map(int, string.split(month, "-"))
+	return toPosix(datetime.datetime(year, month, 1))
+
+def shard_months(start, end):
+	"""
+	Returns the YYYY-MM months which overlap the POSIX times start to end.
+	"""
+	months = [ shard_month(start) ]
+	last = shard_month(end)
+	while months[-1] < last:
+		months.append(next_month(months[-1]))
+	return months
+
+class ShardRouter(object):
+	"""
+	Queries the monthly shards of databaseFile as though they were a single
+	database. cover() attaches the shards a time range needs and replaces each
+	table with a temporary view of the union of that table across them, so
+	that queries written against a single database run unchanged.
+
+	Node IDs are per shard, so the node columns of different shards cannot be
+	compared.
+	"""
+	# Results written shortly after the end of a month, such as those still
+	# queued when it ended, are in the next month's shard.
+	slack = 3600
+
+	def __init__(self, databaseFile):
+		self.databaseFile = databaseFile
+		self.db = sqlite3.connect(":memory:")
+		self.attached = []
+		self.views = []
+
+	def months(self):
+		"""
+		Returns the months which have shards, in order.
+		"""
+		root, extension = os.path.splitext(self.databaseFile)
+		paths = glob.glob(shard_path(self.databaseFile, "[0-9][0-9][0-9][0-9]-[0-9][0-9]"))
+		return sorted([ path[len(root) + 1:len(path) - len(extension)] for path in paths ])
+
+	def cover(self, start, end):
+		"""
+		Attach the shards holding results from start to end, which are POSIX
+		times or UTC datetimes.
+		"""
+		if isinstance(start, datetime.datetime):
+			start = toPosix(start)
+		if isinstance(end, datetime.datetime):
+			end = toPosix(end)
+
+		existing = self.months()
+		self.attach([ month for month in shard_months(start, end + self.slack) if month in existing ])
+
+	def spans(self, start, end):
+		"""
+		Attaches the shards for each month from the POSIX time start up to end
+		in turn: that month's, and the next month's, which holds the results
+		written just after it ended. Yields the start and end of the part of
+		the range in the month once they are attached. Unlike cover() this
+		attaches at most two shards at once, however long the range, as
+		SQLite can attach at most 10.
+		"""
+		existing = self.months()
+		for month in shard_months(start, max(start, end - 1)):
+			following = next_month(month)
+			self.attach([ shard for shard in [ month, following ] if shard in existing ])
+			if self.attached:
+				yield max(start, month_start(month)), min(end, month_start(following))
+
+	def coverEarliest(self):
+		"""
+		Attach only the earliest shard.
+		"""
+		self.attach(self.months()[:1])
+
+	def attach(self, months):
+		if months == self.attached:
+			return
+
+		for view in self.views:
+			self.db.execute("""drop view temp."{0}" """.format(view))
+		for index in range(len(self.attached)):
+			self.db.execute("""detach database "shard{0}" """.format(index))
+		self.attached = []
+		self.views = []
+
+		# Shards stay immutable: they are only read from here.
+		for index, month in enumerate(months):
+			self.db.execute("""attach database ? as "shard{0}" """.format(index), (shard_path(self.databaseFile, month),))
+			configure_reader(self.db, "shard{0}".format(index))
+		self.attached = months
+
+		if not months:
+			return
+
+		tables = [ row[0] for row in self.db.execute("""select name from "shard0".sqlite_master where type == 'table' and name not like 'sqlite_%'""") ]
+		for table in tables:
+			union = string.join([ """select * from "shard{0}"."{1}" """.format(index, table) for index in range(len(months)) ], "union all ")
+			self.db.execute("""create temp view "{0}" as {1}""".format(table, union))
+			self.views.append(table)
+
+	def execute(self, *args):
+		return self.db.execute(*args)
 
+	def close(self):
+		self.db.close()
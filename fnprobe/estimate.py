@@ -0,0 +1,227 @@
+from collections import defaultdict
+
+# The network size estimate is made from the number of identifier results
+# and the number of distinct identifiers among them. For an effective size
+# estimate these are taken from the intersection of two adjacent periods of
+# the same length: for each identifier seen a times in the earlier period and
+# b times in the later one, the samples are the sum of a * b and the distinct
+# samples the number of identifiers with both a and b nonzero. Periods
+# include both their start and end, so a result at the boundary is in both.
+
+# Distinct and total samples in the intersection of the periods from ?1 to ?2
+# and ?2 to ?3.
+intersectionQuery = """
+SELECT
+  COUNT(DISTINCT identifier), COUNT(identifier)
+FROM
+  (SELECT
+    i1.identifier
+   FROM identifier i1
+     JOIN identifier i2
+     USING(identifier)
+   WHERE i1.time BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
+     AND i2.time BETWEEN strftime('%s', ?2) AND strftime('%s', ?3)
+  )
+"""
+
+# Distinct and total samples in the period from ?1 to ?2.
+instantaneousQuery = """
+SELECT
+  COUNT(DISTINCT "identifier"), COUNT("identifier")
+FROM
+  "identifier"
+WHERE
+  time BETWEEN strftime('%s', ?1) AND strftime('%s', ?2)
+"""
+
+# Identifier results in time order from the POSIX time ?1 up to ?2 with the
+# number of times each was seen, as read by SizeEstimator. Results compacted
+# into identifier_hourly are only known to an hour, so they are placed in the
+# middle of their hour. Periods which start and end on the hour count them as
+# before, except those seen exactly on the hour, which an adjacent period also
+# counted. Other periods count them as though seen at half past.
+identifierStreamQuery = """
+SELECT
+  "time", "identifier", 1
+FROM
+  "identifier"
+WHERE
+  "time" >= ?1 AND "time" < ?2 AND "identifier" IS NOT NULL
+UNION ALL
+SELECT
+  "hour" + 1800, "identifier", "count"
+FROM
+  "identifier_hourly"
+WHERE
+  "hour" >= ?1 - 1800 AND "hour" < ?2 - 1800
+ORDER BY
+  "time"
+"""
+
+class ResultStream(object):
+	"""
+	Buffers (time, identifier, count) rows read in time order so that several
+	edges can each read through them once, at their own pace. Each row is
+	buffered count times. Rows are dropped from the buffer once every edge
+	has passed them.
+	"""
+	def __init__(self, rows):
+		self.rows = iter(rows)
+		self.buffer = []
+		# Position in the stream of the first row of the buffer.
+		self.offset = 0
+		self.edges = []
+		self.exhausted = False
+
+	def edge(self):
+		edge = Edge(self)
+		self.edges.append(edge)
+		return edge
+
+	def row(self, position):
+		"""
+		Returns the row at the position, or None if the stream ended first.
+		"""
+		while position - self.offset >= len(self.buffer):
+			if self.exhausted:
+				return None
+			try:
+				time, identifier, count = next(self.rows)
+				self.buffer.extend([ (time, identifier) ] * count)
+			except StopIteration:
+				self.exhausted = True
+				return None
+		return self.buffer[position - self.offset]
+
+	def trim(self):
+		passed = min(edge.position for edge in self.edges) - self.offset
+		# Deleting from the front of a list is linear, so only do it once
+		# there is as much to delete as to keep.
+		if passed > 0 and passed >= len(self.buffer) - passed:
+			del self.buffer[:passed]
+			self.offset += passed
+
+class Edge(object):
+	"""
+	A position in a ResultStream.
+	"""
+	def __init__(self, stream):
+		self.stream = stream
+		self.position = stream.offset
+
+	def before(self, bound):
+		"""
+		Returns the identifiers of the rows from the position up to those at or
+		after the POSIX time bound, and moves past them.
+		"""
+		identifiers = []
+		while True:
+			row = self.stream.row(self.position)
+			if row is None or row[0] >= bound:
+				return identifiers
+			identifiers.append(row[1])
+			self.position += 1
+
+	def through(self, bound):
+		"""
+		Returns the identifiers of the rows from the position up to those after
+		the POSIX time bound, and moves past them.
+		"""
+		identifiers = []
+		while True:
+			row = self.stream.row(self.position)
+			if row is None or row[0] > bound:
+				return identifiers
+			identifiers.append(row[1])
+			self.position += 1
+
+class Window(object):
+	"""
+	Count of each identifier among the results from start to end inclusive,
+	which only move forward. When it is one of a pair other is the other, and
+	changes to its counts update the intersection of the pair.
+	"""
+	def __init__(self, stream, intersection=None):
+		self.lower = stream.edge()
+		self.upper = stream.edge()
+		self.counts = defaultdict(int)
+		self.samples = 0
+		self.intersection = intersection
+		self.other = None
+
+	def move(self, start, end):
+		for identifier in self.upper.through(end):
+			self.add(identifier)
+		for identifier in self.lower.before(start):
+			self.remove(identifier)
+
+	def distinct(self):
+		return len(self.counts)
+
+	def add(self, identifier):
+		count = self.counts[identifier] = self.counts[identifier] + 1
+		self.samples += 1
+		if self.intersection is not None:
+			otherCount = self.other.counts.get(identifier, 0)
+			self.intersection.samples += otherCount
+			if count == 1 and otherCount:
+				self.intersection.distinct += 1
+
+	def remove(self, identifier):
+		count = self.counts[identifier] = self.counts[identifier] - 1
+		if count == 0:
+			del self.counts[identifier]
+		self.samples -= 1
+		if self.intersection is not None:
+			otherCount = self.other.counts.get(identifier, 0)
+			self.intersection.samples -= otherCount
+			if count == 0 and otherCount:
+				self.intersection.distinct -= 1
+
+class Intersection(object):
+	"""
+	Distinct and total samples in the intersection of the two adjacent
+	periods of the given length ending at a time, as from intersectionQuery.
+	"""
+	def __init__(self, stream, period):
+		self.period = period
+		self.distinct = 0
+		self.samples = 0
+		self.earlier = Window(stream, self)
+		self.later = Window(stream, self)
+		self.earlier.other = self.later
+		self.later.other = self.earlier
+
+	def move(self, end):
+		self.earlier.move(end - 2 * self.period, end - self.period)
+		self.later.move(end - self.period, end)
+
+class SizeEstimator(object):
+	"""
+	Computes the samples for each size estimate, as from intersectionQuery and
+	instantaneousQuery, for a sequence of increasing end times while reading
+	the identifier results only once. rows are (time, identifier, count) in
+	time order, starting no later than the start of the first longest period; see
+	identifierStreamQuery. Periods are in seconds.
+	"""
+	def __init__(self, rows, shortPeriod, mediumPeriod, longPeriod):
+		self.stream = ResultStream(rows)
+		self.shortPeriod = shortPeriod
+		self.instantaneous = Window(self.stream)
+		self.medium = Intersection(self.stream, mediumPeriod)
+		self.long = Intersection(self.stream, longPeriod)
+
+	def advance(self, end):
+		"""
+		Returns (distinct, samples) of the instantaneous period and the medium
+		and long intersections ending at the POSIX time end, which must not be
+		earlier than the last.
+		"""
+		self.instantaneous.move(end - self.shortPeriod, end)
+		self.medium.move(end)
+		self.long.move(end)
+		self.stream.trim()
+
+		return ((self.instantaneous.distinct(), self.instantaneous.samples),
+		        (self.medium.distinct, self.medium.samples),
+		        (self.long.distinct, self.long.samples))
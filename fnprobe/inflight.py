@@ -0,0 +1,79 @@
+import heapq
+from twisted.internet import reactor
+
+class InFlight(object):
+	"""
+	Registry of probes awaiting a response, keyed by request identifier.
+
+	Each probe has a deadline timeout seconds after it is sent. Probes still
+	pending at their deadline are removed and passed to expired. Deadlines are
+	kept in a heap, and a single timer is scheduled for the earliest one.
+	Responses remove probes from the registry but leave their heap entries,
+	which are skipped when reached.
+	"""
+	def __init__(self, timeout, maxPending, expired):
+		self.timeout = timeout
+		self.maxPending = maxPending
+		self.expired = expired
+
+		# Identifier to (deadline, probe).
+		self.pending = {}
+		# Heap of (deadline, identifier).
+		self.deadlines = []
+		self.expireCall = None
+
+	def __len__(self):
+		return len(self.pending)
+
+	def full(self):
+		return len(self.pending) >= self.maxPending
+
+	def add(self, identifier, probe):
+		deadline = reactor.seconds() + self.timeout
+		self.pending[identifier] = (deadline, probe)
+		heapq.heappush(self.deadlines, (deadline, identifier))
+
+		if self.expireCall is None:
+			self.expireCall = reactor.callLater(self.timeout, self.expire)
+
+	def remove(self, identifier):
+		"""
+		Returns the probe with the given identifier, or None if it already
+		expired.
+		"""
+		entry = self.pending.pop(identifier, None)
+		if entry is None:
+			return None
+		return entry[1]
+
+	def clear(self):
+		"""
+		Removes all pending probes without expiring them, as when the
+		connection they were sent on is lost, and returns them.
+		"""
+		probes = [ probe for deadline, probe in self.pending.values() ]
+		self.pending = {}
+		self.deadlines = []
+		if self.expireCall is not None:
+			self.expireCall.cancel()
+			self.expireCall = None
+		return probes
+
+	def expire(self):
+		self.expireCall = None
+		now = reactor.seconds()
+
+		while self.deadlines and self.deadlines[0][0] <= now:
+			deadline, identifier = heapq.heappop(self.deadlines)
+			entry = self.pending.get(identifier)
+			# Skip probes which were answered.
+			if entry is not None and entry[0] == deadline:
+				del self.pending[identifier]
+				self.expired(entry[1])
+
+		# Drop answered probes from the front of the heap.
+		while self.deadlines and self.deadlines[0][1] not in self.pending:
+			heapq.heappop(self.deadlines)
+
+		if self.deadlines:
+			self.expireCall = reactor.callLater(self.deadlines[0][0] - now, self.expire)
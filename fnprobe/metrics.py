@@ -0,0 +1,141 @@
+from __future__ import division
+import bisect
+from string import join
+from twisted.web import resource, server
+
+# Metrics exported in the Prometheus text format. Updating them only changes
+# values in memory; rendering them happens when the endpoint is requested.
+# See https://prometheus.io/docs/instrumenting/exposition_formats/
+
+def formatLabels(names, values):
+	if not names:
+		return ''
+	pairs = [ '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+	          for name, value in zip(names, values) ]
+	return '{' + join(pairs, ',') + '}'
+
+class Counter(object):
+	def __init__(self, name, description, labels=()):
+		self.name = name
+		self.description = description
+		self.labels = labels
+		self.values = {}
+
+	def inc(self, labels=(), amount=1):
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+	def render(self):
+		lines = [ '# HELP {0} {1}'.format(self.name, self.description),
+		          '# TYPE {0} counter'.format(self.name) ]
+		for labels, value in sorted(self.values.items()):
+			lines.append('{0}{1} {2}'.format(self.name, formatLabels(self.labels, labels), value))
+		return lines
+
+class Gauge(object):
+	"""
+	Either set directly or tracked by a function called when rendering.
+	"""
+	def __init__(self, name, description, labels=()):
+		self.name = name
+		self.description = description
+		self.labels = labels
+		self.values = {}
+		self.functions = {}
+
+	def set(self, value, labels=()):
+		self.values[labels] = value
+
+	def track(self, function, labels=()):
+		self.functions[labels] = function
+
+	def render(self):
+		values = dict(self.values)
+		for labels, function in self.functions.items():
+			values[labels] = function()
+
+		lines = [ '# HELP {0} {1}'.format(self.name, self.description),
+		          '# TYPE {0} gauge'.format(self.name) ]
+		for labels, value in sorted(values.items()):
+			lines.append('{0}{1} {2}'.format(self.name, formatLabels(self.labels, labels), value))
+		return lines
+
+class Histogram(object):
+	def __init__(self, name, description, buckets, labels=()):
+		self.name = name
+		self.description = description
+		self.buckets = sorted(buckets)
+		self.labels = labels
+		# Per label values: [ counts per bucket plus +Inf, sum ]
+		self.values = {}
+
+	def observe(self, value, labels=()):
+		entry = self.values.get(labels)
+		if entry is None:
+			entry = self.values[labels] = [ [ 0 ] * (len(self.buckets) + 1), 0 ]
+		entry[0][bisect.bisect_left(self.buckets, value)] += 1
+		entry[1] += value
+
+	def render(self):
+		lines = [ '# HELP {0} {1}'.format(self.name, self.description),
+		          '# TYPE {0} histogram'.format(self.name) ]
+		for labels, (counts, total) in sorted(self.values.items()):
+			cumulative = 0
+			for bound, count in zip(self.buckets + [ '+Inf' ], counts):
+				cumulative += count
+				lines.append('{0}_bucket{1} {2}'.format(self.name, formatLabels(self.labels + ('le',), labels + (bound,)), cumulative))
+			lines.append('{0}_sum{1} {2}'.format(self.name, formatLabels(self.labels, labels), total))
+			lines.append('{0}_count{1} {2}'.format(self.name, formatLabels(self.labels, labels), cumulative))
+		return lines
+
+class Registry(object):
+	def __init__(self):
+		self.metrics = []
+
+	def add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def render(self):
+		lines = []
+		for metric in self.metrics:
+			lines += metric.render()
+		return join(lines, '\n') + '\n'
+
+registry = Registry()
+
+# Outcome is "success", "refused", or the error type.
+probes = registry.add(Counter('pyprobe_probes_total', 'Probe responses by probe type and outcome.',
+                              ('node', 'probe_type', 'outcome')))
+
+probeDuration = registry.add(Histogram('pyprobe_probe_duration_seconds', 'Seconds between sending a probe and its response.',
+                                       [ 0.5, 1, 2, 5, 10, 20, 30, 60, 90, 120 ], ('node',)))
+
+commitDuration = registry.add(Histogram('pyprobe_commit_duration_seconds', 'Seconds taken to commit a batch of results.',
+                                        [ 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60 ]))
+
+inflight = registry.add(Gauge('pyprobe_inflight_probes', 'Probes awaiting a response.', ('node',)))
+
+queueDepth = registry.add(Gauge('pyprobe_writer_queue_depth', 'Results not yet committed to the database.'))
+
+walSize = registry.add(Gauge('pyprobe_wal_bytes', 'Size of the write-ahead log after the last checkpoint.'))
+
+# Mode is "passive", "truncate", or "truncate-busy" if a reader prevented truncation.
+checkpointDuration = registry.add(Histogram('pyprobe_checkpoint_duration_seconds', 'Seconds taken by WAL checkpoints by mode.',
+                                            [ 0.001, 0.01, 0.1, 0.5, 1, 5, 10, 60 ], ('mode',)))
+
+writerPaused = registry.add(Gauge('pyprobe_writer_paused', '1 if sending is paused because too many results await commit, otherwise 0.'))
+
+reconnects = registry.add(Gauge('pyprobe_reconnects', 'Times the connection to the node was made again after the first.', ('node',)))
+
+class MetricsResource(resource.Resource):
+	isLeaf = True
+
+	def render_GET(self, request):
+		request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+		return registry.render()
+
+def listen(reactor, port, interface):
+	"""
+	Serve metrics over HTTP on the given port and interface.
+	"""
+	return reactor.listenTCP(port, server.Site(MetricsResource()), interface=interface)
@@ -0,0 +1,117 @@
+from __future__ import division
+import logging
+import random
+from string import split
+from twisted.internet import reactor
+
+# Selects the type of each probe to send. A scheduler is constructed with the
+# probe arguments, returns the type of the next probe from next(), and is
+# told of each response or timeout with record(). Probes which will get
+# neither, such as those outstanding when the connection is lost, are instead
+# passed to cancel().
+
+class RandomScheduler(object):
+	"""
+	Chooses uniformly from the configured types. Repeating a type in the list
+	weights it more heavily.
+	"""
+	def __init__(self, args):
+		self.types = args.types
+
+	def next(self):
+		return random.choice(self.types)
+
+	def record(self, probeType, header, result):
+		pass
+
+	def cancel(self, probeType):
+		pass
+
+class QuotaScheduler(object):
+	"""
+	Aims for a target number of successful results of each type per hour. It
+	sends the type furthest behind its quota for the fraction of the hour that
+	has passed, counting probes still awaiting a response as if they will
+	succeed. Once all types are on schedule it chooses in proportion to the
+	quotas.
+
+	The size estimate needs identifiers to be seen more than once within an
+	hour. While fewer than minCollisions identifier results this hour were
+	repeats, the IDENTIFIER quota is multiplied by identifierBoost.
+	"""
+	def __init__(self, args):
+		self.quotas = {}
+		for entry in split(args.quotas, ","):
+			probeType, quota = split(entry.strip(), ":")
+			self.quotas[probeType] = int(quota)
+		self.types = sorted(self.quotas.keys())
+
+		self.identifierBoost = args.identifierBoost
+		self.minCollisions = args.minCollisions
+
+		self.inflight = dict((probeType, 0) for probeType in self.types)
+		self.startHour(int(reactor.seconds() // 3600))
+
+	def startHour(self, hour):
+		self.hour = hour
+		self.successes = dict((probeType, 0) for probeType in self.types)
+		self.identifiers = set()
+		self.identifierResults = 0
+
+	def quota(self, probeType):
+		quota = self.quotas[probeType]
+		if probeType == "IDENTIFIER" and self.identifierResults - len(self.identifiers) < self.minCollisions:
+			quota *= self.identifierBoost
+		return quota
+
+	def next(self):
+		now = reactor.seconds()
+		hour = int(now // 3600)
+		if hour != self.hour:
+			logging.info("Results last hour against quotas: {0}".format(
+			             ", ".join("{0} {1}/{2}".format(probeType, self.successes[probeType], self.quota(probeType))
+			                       for probeType in self.types)))
+			self.startHour(hour)
+
+		elapsed = (now % 3600) / 3600
+		deficits = [ (self.quota(probeType) * elapsed - self.successes[probeType] - self.inflight[probeType], probeType)
+		             for probeType in self.types ]
+		deficit, probeType = max(deficits)
+
+		if deficit <= 0:
+			# Every type is on schedule; choose in proportion to quota.
+			point = random.uniform(0, sum(self.quota(probeType) for probeType in self.types))
+			for probeType in self.types:
+				point -= self.quota(probeType)
+				if point <= 0:
+					break
+
+		self.inflight[probeType] += 1
+		return probeType
+
+	def record(self, probeType, header, result):
+		self.inflight[probeType] = max(0, self.inflight[probeType] - 1)
+		if header in [ "ProbeError", "ProbeRefused" ]:
+			return
+
+		self.successes[probeType] += 1
+		if probeType == "IDENTIFIER":
+			self.identifierResults += 1
+			self.identifiers.add(result["ProbeIdentifier"])
+
+	def cancel(self, probeType):
+		self.inflight[probeType] = max(0, self.inflight[probeType] - 1)
+
+schedulers = { "random": RandomScheduler, "quota": QuotaScheduler }
+
+def makeScheduler(args):
+	"""
+	Returns the scheduler named by args.scheduler: "random", "quota", or the
+	dotted path of a class implementing the same methods.
+	"""
+	name = args.scheduler
+	if name in schedulers:
+		return schedulers[name](args)
+
+	module, className = name.rsplit(".", 1)
+	return getattr(__import__(module, fromlist=[ className ]), className)(args)
@@ -0,0 +1,66 @@
+from __future__ import division
+import numpy as np
+
+# Network size is estimated from the number of samples and distinct samples
+# among them as the size n solving
+#
+#     distinct = n * (1 - e^(-samples / n))
+#
+# which is the expected number of distinct samples when drawing the given
+# number uniformly from n. With x = samples / n this is (1 - e^(-x)) / x = r
+# for r = distinct / samples, which has a single solution for 0 < r < 1.
+
+# Without at least this many repeated samples there is not enough
+# information to make an estimate.
+minimumRepeats = 3
+
+def formula(samples, networkSize):
+	"""
+	Expected distinct samples. Accurate even when samples are a tiny
+	fraction of the network size.
+	"""
+	return -networkSize * np.expm1(-samples / networkSize)
+
+def estimate(distinct, samples, tolerance=1e-10, iterations=100):
+	"""
+	Returns the network size estimated from arrays of distinct samples and
+	samples, or NaN where there are too few repeated samples to estimate.
+	Scalars give a scalar.
+	"""
+	distinct = np.asarray(distinct, dtype=float)
+	samples = np.asarray(samples, dtype=float)
+	scalar = distinct.ndim == 0 and samples.ndim == 0
+	distinct, samples = np.broadcast_arrays(np.atleast_1d(distinct), np.atleast_1d(samples))
+
+	valid = (np.abs(samples - distinct) >= minimumRepeats) & (distinct > 0) & (distinct < samples)
+	size = np.full(distinct.shape, np.nan)
+	s = samples[valid]
+	logR = np.log1p((distinct[valid] - s) / s)
+
+	# Newton's method on t = log(x) for
+	#   phi(t) = log((1 - e^(-x)) / x) - log(r) = 0
+	# phi is concave and decreasing in t, so from a start above the root
+	# every step stays above it and converges. x < 1 / r because
+	# (1 - e^(-x)) / x < 1 / x. For r near 1, where that is far above the
+	# root, (1 - e^(-x)) / x < 1 - x/2 + x^2/6 gives a closer bound.
+	t = -logR
+	near = logR > np.log(5 / 8)
+	t[near] = np.log(1.5 * (1 - np.sqrt(1 - 8 * -np.expm1(logR[near]) / 3)))
+
+	active = np.arange(len(t))
+	for _ in range(iterations):
+		if len(active) == 0:
+			break
+		x = np.exp(t[active])
+		phi = np.log(-np.expm1(-x) / x) - logR[active]
+		# x / (e^x - 1) - 1, without overflowing for large x.
+		slope = x * np.exp(-x) / -np.expm1(-x) - 1
+		step = phi / slope
+		t[active] -= step
+		active = active[np.abs(step) > tolerance]
+
+	size[valid] = s / np.exp(t)
+
+	if scalar:
+		return float(size[0])
+	return size
@@ -1,3 +1,4 @@
+from __future__ import division
 import calendar
 import datetime
 import exceptions
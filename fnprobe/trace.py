@@ -0,0 +1,41 @@
+from __future__ import absolute_import
+import json
+import random
+import time
+
+# Stages timestamped in each trace, in order:
+# * created: the probe request is about to be made.
+# * sent: the request was handed to the protocol.
+# * received: the response arrived.
+# * handoff: the batch holding the result was handed to the database thread.
+# * insert: the database thread started inserting the result.
+# * commit: the transaction holding the result committed.
+stages = [ "created", "sent", "received", "handoff", "insert", "commit" ]
+
+def now():
+	return time.time()
+
+class Tracer(object):
+	"""
+	Records the time each stage of a sample of probes was reached. Each trace
+	is written to the trace file as a line of JSON once its result is
+	committed.
+	"""
+	def __init__(self, path, sampleRate):
+		self.sampleRate = sampleRate
+		self.output = open(path, 'a')
+
+	def start(self, identifier, probeType, node, created):
+		"""
+		Returns a new trace for the probe if it is sampled, otherwise None.
+		"""
+		if random.random() >= self.sampleRate:
+			return None
+
+		return { "id": str(identifier), "type": probeType, "node": node, "created": created }
+
+	def write(self, trace):
+		self.output.write(json.dumps(trace) + '\n')
+
+	def close(self):
+		self.output.close()
@@ -0,0 +1,486 @@
+from __future__ import absolute_import, division
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+from fnprobe.db import forget_node_ids, shard_month, shard_path
+from fnprobe.time import totalSeconds
+from fnprobe import metrics, trace
+
+# Seconds between logging write throughput.
+statsPeriod = 60
+
+class ShardedPool(object):
+	"""
+	Used in place of a ConnectionPool to write to the shard of databaseFile for
+	the current month. When the month changes a pool for the new shard is
+	opened, and init is run on it before anything else. The previous pool is
+	closed once the operations already started on it finish, after which its
+	shard is no longer written to.
+
+	Remaining keyword arguments are passed to each ConnectionPool.
+	"""
+	def __init__(self, databaseFile, init, **kwargs):
+		self.databaseFile = databaseFile
+		self.init = init
+		self.kwargs = kwargs
+
+		self.month = None
+		self.pool = None
+		# Operations not yet finished by pool.
+		self.running = {}
+
+	def current(self):
+		month = shard_month(reactor.seconds())
+		if month != self.month:
+			previous = self.pool
+			path = shard_path(self.databaseFile, month)
+			logging.warning("Writing to shard {0}.".format(path))
+
+			self.month = month
+			self.pool = adbapi.ConnectionPool('sqlite3', path, **self.kwargs)
+			self.running[self.pool] = 0
+			# With a single connection operations run in the order they are
+			# started, so the shard is initialized before anything uses it.
+			self.run(self.pool, self.init).addErrback(lambda failure: logging.error("Failed to initialize shard {0}: {1}".format(path, failure.getErrorMessage())))
+
+			if previous is not None and self.running[previous] == 0:
+				self.closePool(previous)
+
+		return self.pool
+
+	def run(self, pool, function, *args, **kwargs):
+		self.running[pool] += 1
+
+		def finished(result):
+			self.running[pool] -= 1
+			if pool is not self.pool and self.running[pool] == 0:
+				self.closePool(pool)
+			return result
+
+		return pool.runWithConnection(function, *args, **kwargs).addBoth(finished)
+
+	def closePool(self, pool):
+		del self.running[pool]
+		pool.close()
+
+	def runWithConnection(self, function, *args, **kwargs):
+		return self.run(self.current(), function, *args, **kwargs)
+
+	def close(self):
+		for pool in self.running.keys():
+			self.closePool(pool)
+
+class Checkpointer(object):
+	"""
+	Checkpoints the write-ahead log every interval seconds from the database
+	thread of pool, in place of SQLite's automatic checkpoints, which long
+	reads such as analyze.py's can starve while the WAL grows.
+
+	Checkpoints are passive, so they never wait on readers or block them.
+	If the WAL is then larger than truncateSize bytes, and the passive
+	checkpoint copied all of it so that no reader needs it, the checkpoint is
+	repeated in TRUNCATE mode to reset the WAL to zero bytes. This does not
+	wait for the lock either: if a reader started meanwhile it is tried again
+	next time.
+	"""
+	def __init__(self, pool, interval, truncateSize):
+		self.pool = pool
+		self.truncateSize = truncateSize
+		self.loop = LoopingCall(self.run)
+		self.loop.start(interval, now=False)
+
+	def run(self):
+		return self.pool.runWithConnection(self.checkpoint).addCallbacks(self.checkpointed, self.failed)
+
+	def checkpoint(self, db):
+		"""
+		Runs in the database thread. Returns the WAL size in bytes before and
+		after, and the mode and duration in seconds of each checkpoint run.
+		"""
+		# Automatic checkpoints are per connection, and the pool may have
+		# opened a new one.
+		db.execute("""PRAGMA wal_autocheckpoint = 0""")
+
+		before = self.walSize(db)
+		checkpoints = []
+
+		start = time.time()
+		busy, frames, copied = db.execute("""PRAGMA wal_checkpoint(PASSIVE)""").fetchone()
+		checkpoints.append(("passive", time.time() - start))
+
+		if before > self.truncateSize and busy == 0 and copied == frames:
+			timeout = db.execute("""PRAGMA busy_timeout""").fetchone()[0]
+			db.execute("""PRAGMA busy_timeout = 0""")
+			try:
+				start = time.time()
+				busy = db.execute("""PRAGMA wal_checkpoint(TRUNCATE)""").fetchone()[0]
+				checkpoints.append(("truncate" if busy == 0 else "truncate-busy", time.time() - start))
+			finally:
+				db.execute("""PRAGMA busy_timeout = {0}""".format(timeout))
+
+		return before, self.walSize(db), checkpoints
+
+	def walSize(self, db):
+		for row in db.execute("""PRAGMA database_list"""):
+			if row[1] == "main" and row[2] and os.path.exists(row[2] + "-wal"):
+				return os.path.getsize(row[2] + "-wal")
+		return 0
+
+	def checkpointed(self, result):
+		before, after, checkpoints = result
+		metrics.walSize.set(after)
+		for mode, duration in checkpoints:
+			metrics.checkpointDuration.observe(duration, (mode,))
+
+		logging.info("Checkpointed WAL of {0} bytes, now {1} bytes: {2}.".format(before, after,
+		             ", ".join("{0} in {1:.3f} seconds".format(mode, duration) for mode, duration in checkpoints)))
+
+	def failed(self, failure):
+		logging.warning("WAL checkpoint failed: {0}".format(failure.getErrorMessage()))
+
+	def stop(self):
+		if self.loop.running:
+			self.loop.stop()
+
+class BatchWriter(object):
+	"""
+	Queues probe results in memory and commits them in a single transaction
+	once batchSize results are queued or batchInterval seconds have passed
+	since the first queued result, whichever comes first.
+
+	insert is called in the database thread with the connection followed by
+	the fields of each queued result.
+
+	Results may be queued with a trace, which has the time of each stage of
+	writing added and is written to the tracer once the result is committed.
+
+	A result which fails to insert, other than because the database is
+	locked, is logged and skipped without losing the rest of its batch.
+
+	If the database stays locked through retries attempts, backing off
+	exponentially from retryDelay seconds, the batch is appended to the spool
+	file at spoolPath instead. Spooled results are replayed once a later batch
+	commits successfully.
+
+	Once highWatermark results await commit the writer is paused, and once no
+	more than lowWatermark do it resumes. Each of its listeners has
+	writerPaused() or writerResumed() called when this happens. Without a
+	highWatermark the writer is never paused.
+	"""
+	def __init__(self, pool, insert, batchSize, batchInterval, retries, retryDelay, spoolPath,
+	             highWatermark=None, lowWatermark=None):
+		self.pool = pool
+		self.insert = insert
+		self.batchSize = batchSize
+		self.batchInterval = batchInterval
+		self.retries = retries
+		self.retryDelay = retryDelay
+		self.spoolPath = spoolPath
+		self.highWatermark = highWatermark
+		self.lowWatermark = lowWatermark
+
+		self.paused = False
+		self.listeners = []
+
+		# Whether the spool may hold results. Only accessed from the database
+		# thread after this.
+		self.spooled = os.path.exists(spoolPath)
+
+		self.queue = []
+		# Time each queued result was added, and its trace if any.
+		self.queueTimes = []
+		self.queueTraces = []
+		self.flushCall = None
+		self.tracer = None
+		self.checkpointer = None
+
+		# Results handed to the database thread and not yet committed, and the
+		# Deferreds of their batches.
+		self.pending = 0
+		self.committing = []
+		# Results committed since starting.
+		self.totalResults = 0
+
+		# If set, called with the seconds between a result being queued and
+		# committed for each committed result.
+		self.latencyObserver = None
+
+		# Throughput since stats were last logged.
+		self.results = 0
+		self.commits = 0
+		self.statsStart = datetime.datetime.utcnow()
+		self.statsLoop = LoopingCall(self.logStats)
+		self.statsLoop.start(statsPeriod, now=False)
+
+	def add(self, result, trace=None):
+		"""
+		Queue a result, which is a tuple of the arguments to insert after the
+		connection.
+		"""
+		self.queue.append(result)
+		self.queueTimes.append(reactor.seconds())
+		self.queueTraces.append(trace)
+
+		if len(self.queue) >= self.batchSize:
+			self.flush()
+		elif self.flushCall is None:
+			self.flushCall = reactor.callLater(self.batchInterval, self.flush)
+
+		self.checkWatermarks()
+
+	def flush(self):
+		"""
+		Commit all queued results. Returns a Deferred which fires once they
+		are committed.
+		"""
+		if self.flushCall is not None:
+			if self.flushCall.active():
+				self.flushCall.cancel()
+			self.flushCall = None
+
+		if not self.queue:
+			return defer.succeed(None)
+
+		batch = self.queue
+		times = self.queueTimes
+		traces = self.queueTraces
+		self.queue = []
+		self.queueTimes = []
+		self.queueTraces = []
+		self.pending += len(batch)
+
+		handoff = trace.now()
+		for entry in traces:
+			if entry is not None:
+				entry["handoff"] = handoff
+
+		d = self.pool.runWithConnection(self.commit, batch, traces)
+		d.addCallback(self.committed, times, traces)
+		d.addErrback(self.failed, len(batch))
+
+		self.committing.append(d)
+		def finished(result):
+			self.committing.remove(d)
+			return result
+		d.addBoth(finished)
+		return d
+
+	def depth(self):
+		"""
+		Number of results not yet committed.
+		"""
+		return len(self.queue) + self.pending
+
+	def checkWatermarks(self):
+		if self.highWatermark is None:
+			return
+
+		depth = self.depth()
+		if not self.paused and depth >= self.highWatermark:
+			logging.warning("{0} results await commit. Pausing sending until there are {1}.".format(depth, self.lowWatermark))
+			self.paused = True
+			for listener in self.listeners:
+				listener.writerPaused()
+		elif self.paused and depth <= self.lowWatermark:
+			logging.warning("{0} results await commit. Resuming sending.".format(depth))
+			self.paused = False
+			for listener in self.listeners:
+				listener.writerResumed()
+
+	def commit(self, db, batch, traces):
+		"""
+		Runs in the database thread. Inserts the batch in one transaction, or
+		spools it if the database remains locked. Returns the seconds taken to
+		commit the batch, or None if it was spooled.
+		"""
+		start = datetime.datetime.utcnow()
+
+		# Retry on locking timeout with exponential backoff.
+		tries = 0
+		while True:
+			try:
+				self.insertBatch(db, batch, traces)
+				break
+			except sqlite3.OperationalError as ex:
+				# Database locked.
+				if tries >= self.retries:
+					logging.warning("Got operational error '{0}'. Tried {1} times. Spooling {2} results.".format(ex, tries + 1, len(batch)))
+					self.spool(batch)
+					return None
+
+				delay = self.retryDelay * 2**tries
+				logging.warning("Got operational error '{0}'. Tried {1} times before. Retrying in {2} seconds.".format(ex, tries, delay))
+				tries += 1
+				time.sleep(delay)
+
+		elapsed = datetime.datetime.utcnow() - start
+		logging.debug("Committed {0} results in {1}.".format(len(batch), elapsed))
+
+		# The database is writable again. The batch has already committed, so
+		# failing to replay only leaves the spool for the next attempt.
+		if self.spooled:
+			try:
+				self.replay(db)
+			except Exception as ex:
+				logging.error("Failed to replay spooled results: {0!r}. Will try again after the next commit.".format(ex))
+
+		return totalSeconds(elapsed)
+
+	def insertBatch(self, db, batch, traces=None):
+		"""
+		Inserts the batch in one transaction. Each result is inserted within a
+		savepoint, so that one which fails with anything but an OperationalError,
+		such as a malformed result, is rolled back and skipped while the rest
+		commit. Returns the results skipped.
+		"""
+		traces = traces or [ None ] * len(batch)
+		skipped = []
+
+		# The sqlite3 module commits before savepoint statements when it
+		# manages transactions itself, so manage this one explicitly. adbapi
+		# passes a wrapper which reads attributes from the sqlite3 connection
+		# but would set them on itself.
+		connection = getattr(db, "_connection", db)
+		isolationLevel = connection.isolation_level
+		connection.isolation_level = None
+		try:
+			db.execute("""begin""")
+			for result, entry in zip(batch, traces):
+				if entry is not None:
+					entry["insert"] = trace.now()
+				db.execute("""savepoint result""")
+				try:
+					self.insert(db, *result)
+				except sqlite3.OperationalError:
+					raise
+				except Exception as ex:
+					db.execute("""rollback to result""")
+					forget_node_ids(db)
+					logging.error("Skipping result {0} which failed to insert: {1!r}".format(result, ex))
+					skipped.append(result)
+				db.execute("""release result""")
+			db.execute("""commit""")
+		except:
+			db.rollback()
+			forget_node_ids(db)
+			raise
+		finally:
+			connection.isolation_level = isolationLevel
+
+		committed = trace.now()
+		for entry in traces:
+			if entry is not None:
+				entry["commit"] = committed
+
+		return skipped
+
+	def spool(self, batch):
+		"""
+		Append results to the spool file, one JSON list per line.
+		"""
+		with open(self.spoolPath, 'a+') as spool:
+			# Finish a partial line left if interrupted while spooling, so that
+			# the next result is not appended to it.
+			spool.seek(0, os.SEEK_END)
+			if spool.tell() > 0:
+				spool.seek(-1, os.SEEK_END)
+				partial = spool.read(1) != '\n'
+				spool.seek(0, os.SEEK_END)
+				if partial:
+					spool.write('\n')
+			for result in batch:
+				spool.write(json.dumps(result) + '\n')
+			spool.flush()
+			os.fsync(spool.fileno())
+		self.spooled = True
+
+	def replay(self, db):
+		"""
+		Insert the spooled results in one transaction, then empty the spool. If
+		the database is locked again they are left for the next attempt. Lines
+		which cannot be replayed, such as malformed ones, are moved to the file
+		at spoolPath with ".bad" appended instead of being retried.
+		"""
+		batch = []
+		bad = []
+		with open(self.spoolPath, 'r') as spool:
+			for line in spool:
+				try:
+					batch.append(json.loads(line))
+				except ValueError:
+					# A partial line is left if interrupted while spooling.
+					logging.warning("Setting aside malformed spooled result '{0}'.".format(line.strip()))
+					bad.append(line)
+
+		try:
+			skipped = self.insertBatch(db, batch)
+		except sqlite3.OperationalError as ex:
+			logging.warning("Got operational error '{0}' replaying {1} spooled results. Will try again after the next commit.".format(ex, len(batch)))
+			return
+
+		bad.extend(json.dumps(result) + '\n' for result in skipped)
+		if bad:
+			with open(self.spoolPath + '.bad', 'a') as spool:
+				spool.writelines(line if line.endswith('\n') else line + '\n' for line in bad)
+				spool.flush()
+				os.fsync(spool.fileno())
+			logging.warning("Set aside {0} spooled results which could not be replayed in {1}.bad.".format(len(bad), self.spoolPath))
+
+		os.remove(self.spoolPath)
+		self.spooled = False
+		logging.warning("Replayed {0} spooled results.".format(len(batch) - len(skipped)))
+
+	def committed(self, elapsed, times, traces):
+		self.pending -= len(times)
+		self.checkWatermarks()
+
+		if self.tracer is not None:
+			for entry in traces:
+				if entry is not None:
+					self.tracer.write(entry)
+
+		if elapsed is not None:
+			metrics.commitDuration.observe(elapsed)
+			self.results += len(times)
+			self.totalResults += len(times)
+			self.commits += 1
+
+			if self.latencyObserver is not None:
+				now = reactor.seconds()
+				for queued in times:
+					self.latencyObserver(now - queued)
+
+	def failed(self, failure, count):
+		self.pending -= count
+		self.checkWatermarks()
+		logging.error("Failed to commit {0} results: {1}".format(count, failure))
+
+	def logStats(self):
+		now = datetime.datetime.utcnow()
+		elapsed = max(totalSeconds(now - self.statsStart), 1e-6)
+
+		logging.info("Wrote {0} results in {1} commits over {2:.0f} seconds: {3:.2f} results/second, {4:.2f} commits/second. {5} queued."
+		             .format(self.results, self.commits, elapsed, self.results / elapsed, self.commits / elapsed, len(self.queue)))
+
+		self.results = 0
+		self.commits = 0
+		self.statsStart = now
+
+	def stop(self):
+		"""
+		Stop logging and commit anything still queued. Returns a Deferred which
+		fires once every batch handed to the database thread has finished, and
+		its traces, if any, are written.
+		"""
+		if self.statsLoop.running:
+			self.statsLoop.stop()
+		if self.checkpointer is not None:
+			self.checkpointer.stop()
+		self.flush()
+		return defer.DeferredList(list(self.committing))
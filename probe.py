@@ -5,6 +5,7 @@ import sqlite3
 from twisted.enterprise import adbapi
 import datetime
 import time
+from copy import copy
 from sys import exit, stderr
 from twisted.internet import reactor, protocol
 from twisted.internet.task import LoopingCall
@@ -17,7 +18,14 @@ from string import split
 from twistedfcp.protocol import FreenetClientProtocol, IdentifiedMessage
 from twistedfcp import message
 from twisted.python import log
-from fnprobe.db import init_database
+from fnprobe.db import init_database, node_id, pack_lengths, encode_probe_type, encode_error_type, configure_writer
+from fnprobe.db import rollup_error, rollup_refused, rollup_store_size, backfill_step, mark_present
+from fnprobe.writer import BatchWriter, Checkpointer, ShardedPool
+from fnprobe.congestion import AIMDController
+from fnprobe.inflight import InFlight
+from fnprobe import metrics, trace
+from fnprobe.trace import Tracer
+from fnprobe.scheduler import RandomScheduler, makeScheduler
 from fnprobe.time import toPosix, totalSeconds
 
 __version__ = "0.1"
@@ -43,65 +51,74 @@ TYPE = "Type"
 HTL = "HopsToLive"
 LOCAL = "Local"
 
-def insert(db, args, probe_type, result, duration, now):
-	start = datetime.datetime.utcnow()
+# Fields kept from result messages for insertion.
+resultFields = [ BANDWIDTH, BUILD, CODE, PROBE_IDENTIFIER, UPTIME_PERCENT,
+                 LINK_LENGTHS, LOCATION, STORE_SIZE, TYPE, LOCAL ]
 
-	header = result.name
-	htl = args.hopsToLive
+def outcome(header, result):
+	"""
+	Returns "success", "refused", or the error type of a result.
+	"""
+	if header == "ProbeError":
+		return result[TYPE]
+	elif header == "ProbeRefused":
+		return "refused"
+	return "success"
 
-	# Retry insert on locking timeout.
-	tries = 0
-	success = False
-	while not success:
-		try:
-			insertResult(db, header, htl, result, now, duration, probe_type)
-			success = True
-		except sqlite3.OperationalError as ex:
-			# Database locked. Try again.
-			db.rollback()
-			logging.warning("Got operational error '{0}'. Tried {1} times before. Retrying.".format(ex, tries))
-			tries += 1
+def resultValues(message):
+	"""
+	Returns a dictionary of the fields of a result message which are stored.
+	"""
+	return dict((field, message[field]) for field in resultFields if field in message)
 
-	logging.debug("Committed {0} ({1}) in {2}.".format(header, probe_type, datetime.datetime.utcnow() - start))
+def insertResult(db, header, htl, result, now, duration, probe_type, node=None):
+	# Results spooled before nodes were recorded have no node.
+	if node is not None:
+		node = node_id(db, node)
 
-def insertResult(db, header, htl, result, now, duration, probe_type):
 	if header == "ProbeError":
 		#type should always be defined, but the code might not be.
 		code = None
 		if CODE in result:
-			description = result[CODE]
-		db.execute("insert into error(time, htl, probe_type, error_type, code, duration, local) values(?, ?, ?, ?, ?, ?, ?)", (now, htl, probe_type, result[TYPE], code, duration, result[LOCAL]))
+			code = result[CODE]
+		probeCode = encode_probe_type(probe_type)
+		errorCode = encode_error_type(result[TYPE])
+		db.execute("insert into error(time, htl, probe_type, error_type, code, duration, local, node) values(?, ?, ?, ?, ?, ?, ?, ?)", (now, htl, probeCode, errorCode, code, duration, result[LOCAL], node))
+		rollup_error(db, now, probeCode, errorCode, result[LOCAL])
 	elif header == "ProbeRefused":
-		db.execute("insert into refused(time, htl, probe_type, duration) values(?, ?, ?, ?)", (now, htl, probe_type, duration))
+		probeCode = encode_probe_type(probe_type)
+		db.execute("insert into refused(time, htl, probe_type, duration, node) values(?, ?, ?, ?, ?)", (now, htl, probeCode, duration, node))
+		rollup_refused(db, now, probeCode)
 	elif probe_type == "BANDWIDTH":
-		db.execute("insert into bandwidth(time, htl, KiB, duration) values(?, ?, ?, ?)", (now, htl, result[BANDWIDTH], duration))
+		db.execute("insert into bandwidth(time, htl, KiB, duration, node) values(?, ?, ?, ?, ?)", (now, htl, result[BANDWIDTH], duration, node))
 	elif probe_type == "BUILD":
-		db.execute("insert into build(time, htl, build, duration) values(?, ?, ?, ?)", (now, htl, result[BUILD], duration))
+		db.execute("insert into build(time, htl, build, duration, node) values(?, ?, ?, ?, ?)", (now, htl, result[BUILD], duration, node))
 	elif probe_type == "IDENTIFIER":
-		db.execute("insert into identifier(time, htl, identifier, percent, duration) values(?, ?, ?, ?, ?)", (now, htl, result[PROBE_IDENTIFIER], result[UPTIME_PERCENT], duration))
+		db.execute("insert into identifier(time, htl, identifier, percent, duration, node) values(?, ?, ?, ?, ?, ?)", (now, htl, result[PROBE_IDENTIFIER], result[UPTIME_PERCENT], duration, node))
+		mark_present(db, result[PROBE_IDENTIFIER], [ now ])
 	elif probe_type == "LINK_LENGTHS":
-		cur = db.cursor()
 		lengths = split(result[LINK_LENGTHS], ';')
-		cur.execute("insert into peer_count(time, htl, peers, duration) values(?, ?, ?, ?)", (now, htl, len(lengths), duration))
-		new_id = cur.lastrowid
-		for length in lengths:
-			cur.execute("insert into link_lengths(time, htl, length, id) values(?, ?, ?, ?)", (now, htl, length, new_id))
-		cur.close()
+		db.execute("insert into peer_count(time, htl, peers, duration, node, lengths) values(?, ?, ?, ?, ?, ?)", (now, htl, len(lengths), duration, node, pack_lengths(lengths)))
 	elif probe_type == "LOCATION":
-		db.execute("insert into location(time, htl, location, duration) values(?, ?, ?, ?)", (now, htl, result[LOCATION], duration))
+		db.execute("insert into location(time, htl, location, duration, node) values(?, ?, ?, ?, ?)", (now, htl, result[LOCATION], duration, node))
 	elif probe_type == "STORE_SIZE":
-		db.execute("insert into store_size(time, htl, GiB, duration) values(?, ?, ?, ?)", (now, htl, result[STORE_SIZE], duration))
+		db.execute("insert into store_size(time, htl, GiB, duration, node) values(?, ?, ?, ?, ?)", (now, htl, result[STORE_SIZE], duration, node))
+		rollup_store_size(db, now, float(result[STORE_SIZE]))
 	elif probe_type == "UPTIME_48H":
-		db.execute("insert into uptime_48h(time, htl, percent, duration) values(?, ?, ?, ?)", (now, htl, result[UPTIME_PERCENT], duration))
+		db.execute("insert into uptime_48h(time, htl, percent, duration, node) values(?, ?, ?, ?, ?)", (now, htl, result[UPTIME_PERCENT], duration, node))
 	elif probe_type == "UPTIME_7D":
-		db.execute("insert into uptime_7d(time, htl, percent, duration) values(?, ?, ?, ?)", (now, htl, result[UPTIME_PERCENT], duration))
+		db.execute("insert into uptime_7d(time, htl, percent, duration, node) values(?, ?, ?, ?, ?)", (now, htl, result[UPTIME_PERCENT], duration, node))
 
 class sigint_handler:
-	def __init__(self, pool):
+	def __init__(self, pool, writer):
 		self.pool = pool
+		self.writer = writer
 
 	def __call__(self, signum, frame):
 		logging.warning("Got signal {0}. Shutting down.".format(signum))
+		# Queue any buffered results before closing the pool: closing waits
+		# for queued database work to finish.
+		self.writer.stop()
 		self.pool.close()
 		signal(SIGINT, SIG_DFL)
 		reactor.stop()
@@ -116,25 +133,92 @@ def MakeRequest(ProbeType, HopsToLive):
 
 class SendHook:
 	"""
-	Sends a probe of a random type and commits the result to the database.
+	Sends a probe of the type chosen by the factory's scheduler through its
+	connection and queues the result to be committed to the database.
 	"""
-	def __init__(self, args, proto, pool):
+	def __init__(self, factory, proto):
 		self.sent = datetime.datetime.utcnow()
-		self.args = args
-		self.probeType = random.choice(self.args.types)
-		self.pool = pool
+		self.factory = factory
+		self.args = factory.args
+		self.probeType = self.factory.scheduler.next()
 		logging.debug("Sending {0}.".format(self.probeType))
 
-		proto.do_session(MakeRequest(self.probeType, self.args.hopsToLive), self)
+		created = trace.now()
+		request = MakeRequest(self.probeType, self.args.hopsToLive)
+		self.identifier = request.id
+
+		self.trace = None
+		if self.factory.tracer is not None:
+			self.trace = self.factory.tracer.start(self.identifier, self.probeType, self.args.node, created)
+
+		self.proto = proto
+		self.factory.inflight.add(self.identifier, self)
+		proto.do_session(request, self)
+
+		if self.trace is not None:
+			self.trace["sent"] = trace.now()
 
 	def __call__(self, message):
 		delta = datetime.datetime.utcnow() - self.sent
 		duration = totalSeconds(delta)
 		now = toPosix(datetime.datetime.utcnow())
-		#Commit results
-		self.pool.runWithConnection(insert, self.args, self.probeType, message, duration, now)
+
+		if self.factory.inflight.remove(self.identifier) is None:
+			# Already recorded as timed out or dropped with the connection.
+			logging.info("Discarding {0} response to {1} which arrived after {2} seconds.".format(message.name, self.probeType, duration))
+			return True
+
+		values = resultValues(message)
+		self.factory.scheduler.record(self.probeType, message.name, values)
+		if self.trace is not None:
+			self.trace["received"] = trace.now()
+			self.trace["outcome"] = outcome(message.name, values)
+
+		metrics.probes.inc((self.args.node, self.probeType, outcome(message.name, values)))
+		metrics.probeDuration.observe(duration, (self.args.node,))
+
+		if self.factory.controller is not None:
+			self.factory.controller.received(message, duration)
+		#Queue results for commit
+		self.factory.writer.add((message.name, self.args.hopsToLive, values, now, duration, self.probeType, self.args.node), self.trace)
 		return True
 
+	def endSession(self):
+		"""
+		Stop waiting for a response on the connection.
+		"""
+		self.proto.sessions.pop(self.identifier, None)
+
+	def expired(self):
+		"""
+		No response arrived before the timeout. Record it as a local timeout.
+		"""
+		duration = totalSeconds(datetime.datetime.utcnow() - self.sent)
+		now = toPosix(datetime.datetime.utcnow())
+		logging.debug("{0} timed out after {1} seconds.".format(self.probeType, duration))
+		self.endSession()
+
+		metrics.probes.inc((self.args.node, self.probeType, "TIMEOUT"))
+		self.factory.scheduler.record(self.probeType, "ProbeError", { TYPE: "TIMEOUT" })
+
+		if self.factory.controller is not None:
+			self.factory.controller.timedOut()
+		if self.trace is not None:
+			self.trace["received"] = trace.now()
+			self.trace["outcome"] = "TIMEOUT"
+		self.factory.writer.add(("ProbeError", self.args.hopsToLive, { TYPE: "TIMEOUT", LOCAL: "true" }, now, duration, self.probeType, self.args.node), self.trace)
+
+	def dropped(self):
+		"""
+		The connection the probe was sent on was lost, so no response can
+		arrive. This says nothing about the network, so it is only counted in
+		the metrics, not recorded as a result.
+		"""
+		logging.debug("Dropping {0} sent {1} seconds before the connection was lost.".format(self.probeType, totalSeconds(datetime.datetime.utcnow() - self.sent)))
+		self.endSession()
+		metrics.probes.inc((self.args.node, self.probeType, "CONNECTION_LOST"))
+		self.factory.scheduler.cancel(self.probeType)
+
 class Complain:
 	"""
 	Registered on ProtocolError. If the callback is hit, complains loudly
@@ -154,11 +238,38 @@ class FCPReconnectingFactory(protocol.ReconnectingClientFactory):
 	#Log disconnection and reconnection attempts
 	noisy = True
 
-	def __init__(self, args, pool):
+	def __init__(self, args, writer, tracer=None, scheduler=None):
 		self.args = args
-		self.pool = pool
+		self.writer = writer
+		self.tracer = tracer
+		self.scheduler = scheduler or RandomScheduler(args)
+
+		# Whether the node is ready for probes on the current connection.
+		self.ready = False
+		self.sendLoop = None
+		# Stop sending while the writer is too far behind.
+		self.writer.listeners.append(self)
+
+		# Probes awaiting a response. Those not answered within the timeout are
+		# recorded as local timeouts; those outstanding when the connection is
+		# lost are dropped.
+		self.inflight = InFlight(self.args.timeout, self.args.maxPending, SendHook.expired)
+		metrics.inflight.track(self.inflight.__len__, (self.args.node,))
+
+		self.connections = 0
+
+		# With congestion control the rate and number of outstanding probes
+		# adapt to refusals and errors; otherwise probes are sent at probeRate.
+		self.controller = None
+		if self.args.congestionControl:
+			self.controller = AIMDController(self.args.probeRate, self.args.minProbeRate,
+			                                 self.args.maxProbeRate, self.args.congestionThreshold,
+			                                 self.args.timeout, self.setPeriod)
 
 	def buildProtocol(self, addr):
+		self.connections += 1
+		metrics.reconnects.set(self.connections - 1, (self.args.node,))
+
 		proto = FreenetClientProtocol()
 		proto.factory = self
 		proto.timeout = self.args.timeout
@@ -166,16 +277,60 @@ class FCPReconnectingFactory(protocol.ReconnectingClientFactory):
 		proto.deferred['NodeHello'] = self
 		proto.deferred['ProtocolError'] = Complain()
 
-		self.sendLoop = LoopingCall(SendHook, self.args, proto, self.pool)
+		self.sendLoop = LoopingCall(self.send, proto)
 
 		return proto
 
+	def send(self, proto):
+		if self.inflight.full() or \
+		   (self.controller is not None and not self.controller.canSend(len(self.inflight))):
+			logging.debug("Not sending: {0} probes outstanding.".format(len(self.inflight)))
+			return
+
+		SendHook(self, proto)
+
+	def period(self):
+		if self.controller is None:
+			return self.args.probePeriod
+		return self.controller.period()
+
+	def setPeriod(self, period):
+		if self.sendLoop is not None and self.sendLoop.running:
+			self.sendLoop.stop()
+			self.sendLoop.start(period, now=False)
+
+	def startSending(self):
+		if self.ready and not self.writer.paused and not self.sendLoop.running:
+			self.sendLoop.start(self.period())
+
+	def stopSending(self):
+		if self.sendLoop is not None and self.sendLoop.running:
+			self.sendLoop.stop()
+
+	def writerPaused(self):
+		self.stopSending()
+
+	def writerResumed(self):
+		self.startSending()
+
 	def callback(self, message):
-		self.sendLoop.start(self.args.probePeriod)
+		self.ready = True
+		self.startSending()
+		if self.controller is not None:
+			self.controller.start()
 
 	def clientConnectionLost(self, connector, reason):
-		logging.warning("Lost connection: {0}".format(reason))
-		self.sendLoop.stop()
+		logging.warning("Lost connection to {0}: {1}".format(self.args.node, reason))
+		self.ready = False
+		self.stopSending()
+		if self.controller is not None:
+			self.controller.stop()
+
+		dropped = self.inflight.clear()
+		if dropped:
+			logging.warning("Dropping {0} probes awaiting a response from {1}.".format(len(dropped), self.args.node))
+		for probe in dropped:
+			probe.dropped()
 
 		#Any connection loss is failure; reconnect.
 		protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
@@ -195,13 +350,25 @@ def main():
 		setattr(args, arg, get(arg))
 
 	#Convert integer options
-	for arg in [ "port", "hopsToLive", "probeRate" ]:
+	for arg in [ "port", "hopsToLive", "probeRate", "minProbeRate", "maxProbeRate",
+	             "writeBatchSize", "writeRetries", "maxPending", "metricsPort",
+	             "identifierBoost", "minCollisions",
+	             "writeHighWatermark", "writeLowWatermark", "backfillBatchSize",
+	             "walTruncateSize" ]:
 		setattr(args, arg, int(getattr(args, arg)))
 
 	#Convert floating point options.
-	for arg in [ "timeout", "databaseTimeout" ]:
+	for arg in [ "timeout", "databaseTimeout", "writeBatchInterval", "writeRetryDelay", "backfillInterval", "checkpointInterval",
+	             "congestionThreshold", "traceSampleRate" ]:
 		setattr(args, arg, float(getattr(args, arg)))
 
+	#Convert boolean options.
+	for arg in [ "congestionControl", "shardByMonth" ]:
+		setattr(args, arg, getattr(args, arg).lower() == "true")
+
+	# writeBatchInterval is configured in milliseconds.
+	args.writeBatchInterval /= 1000
+
 	#Convert types list to list
 	args.types = split(args.types, ",")
 
@@ -212,6 +379,21 @@ def main():
 	# 1 minute     probeRate probes   probe
 	args.probePeriod = 60 / args.probeRate
 
+	# Nodes to probe through, each as host:port or host:port:probeRate. The
+	# host and port options are used if none are listed.
+	endpoints = [ endpoint.strip() for endpoint in split(args.nodes, ",") if endpoint.strip() ]
+	nodes = []
+	for endpoint in endpoints or [ "{0}:{1}".format(args.host, args.port) ]:
+		fields = split(endpoint, ":")
+		nodeArgs = copy(args)
+		nodeArgs.host = fields[0]
+		nodeArgs.port = int(fields[1])
+		if len(fields) > 2:
+			nodeArgs.probeRate = int(fields[2])
+			nodeArgs.probePeriod = 60 / nodeArgs.probeRate
+		nodeArgs.node = "{0}:{1}".format(nodeArgs.host, nodeArgs.port)
+		nodes.append(nodeArgs)
+
 	logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s", level=getattr(logging, args.verbosity), filename=args.logFile)
 	logging.info("Starting up.")
 
@@ -222,24 +404,72 @@ def main():
 	# Versions of sqlite prior to 3.3.1 are not thread-safe.
 	# See https://www.sqlite.org/releaselog/3_3_1.html
 	#     https://www.sqlite.org/faq.html#q6
-	pool = adbapi.ConnectionPool('sqlite3', args.databaseFile, timeout=args.databaseTimeout, cp_max=1, check_same_thread=False)
+	if args.shardByMonth:
+		pool = ShardedPool(args.databaseFile, init_database, timeout=args.databaseTimeout, cp_max=1, check_same_thread=False,
+		                   cp_openfun=configure_writer)
+	else:
+		pool = adbapi.ConnectionPool('sqlite3', args.databaseFile, timeout=args.databaseTimeout, cp_max=1, check_same_thread=False,
+		                             cp_openfun=configure_writer)
 
 	# Ensure the database holds the required tables, columns, and indicies.
 	# Connect and start sending probes only if this is successful.
 	# Note that runWithConnection() commits if no exceptions are thrown.
 	init = pool.runWithConnection(init_database)
 
+	# Results are committed in batches rather than one transaction each.
+	writer = BatchWriter(pool, insertResult, args.writeBatchSize, args.writeBatchInterval,
+	                     args.writeRetries, args.writeRetryDelay, args.spoolFile,
+	                     args.writeHighWatermark, args.writeLowWatermark)
+	metrics.queueDepth.track(writer.depth)
+	metrics.writerPaused.track(lambda: int(writer.paused))
+
+	# Chooses probe types for all nodes, so that quotas are per process.
+	scheduler = makeScheduler(args)
+
+	# Optionally trace the stages of a sample of probes.
+	tracer = None
+	if args.traceFile:
+		tracer = Tracer(args.traceFile, args.traceSampleRate)
+		writer.tracer = tracer
+		# Close the trace file on shutdown once the writer has finished its
+		# last batches, including the one flushed by the signal handler.
+		reactor.addSystemEventTrigger('before', 'shutdown', lambda: writer.stop().addBoth(lambda result: tracer.close()))
+
+	# The writer's thread checkpoints the WAL in place of automatic checkpoints.
+	writer.checkpointer = Checkpointer(pool, args.checkpointInterval, args.walTruncateSize * 1024 * 1024)
+
+	if args.metricsPort:
+		metrics.listen(reactor, args.metricsPort, args.metricsInterface)
+
 	def databaseInitFailure(failure):
 		logging.error("Database initialization failed: '{0}'".format(failure))
 		exit(1)
 
 	def databaseInitSuccess(d):
-		reactor.connectTCP(args.host, args.port, FCPReconnectingFactory(args, pool))
+		# Each node has its own connection and send rate; all share the writer.
+		for nodeArgs in nodes:
+			logging.info("Connecting to {0}.".format(nodeArgs.node))
+			reactor.connectTCP(nodeArgs.host, nodeArgs.port, FCPReconnectingFactory(nodeArgs, writer, tracer, scheduler))
+
+		# Finish converting existing results after an upgrade. Batches share
+		# the writer's connection, so they take turns with result batches.
+		backfillLoop.start(args.backfillInterval).addErrback(backfillFailure)
+
+	def backfill():
+		def step(remaining):
+			if not remaining and backfillLoop.running:
+				backfillLoop.stop()
+		return pool.runWithConnection(backfill_step, args.backfillBatchSize).addCallback(step)
+
+	def backfillFailure(failure):
+		logging.error("Background database conversion failed; it will resume on restart: '{0}'".format(failure))
+
+	backfillLoop = LoopingCall(backfill)
 
 	init.addErrback(databaseInitFailure)
 	init.addCallback(databaseInitSuccess)
 
-	handler = sigint_handler(pool)
+	handler = sigint_handler(pool, writer)
 	reactor.callWhenRunning(signal, SIGINT, handler)
 	reactor.callWhenRunning(signal, SIGTERM, handler)
 
@@ -1,26 +1,18 @@
-import sqlite3
+from fnprobe.db import connect_writer
 
-# This script recalculates the peer counts by counting the link lengths which
-# were saved at the same time. This is not guarenteed to work, because a
-# timestamp is not an ID, and exists to recover from a peer count bug.
+# This script recalculates the peer counts from the link lengths stored with
+# them, and exists to recover from a peer count bug. Since database version 7
+# each peer_count entry holds its link lengths packed as 8-byte doubles, so the
+# number of peers is the length of the blob divided by 8.
 
-db = sqlite3.connect("database.sql")
+db = connect_writer("database.sql")
 
-# Check that timestamp works as an identifier.
-num_lengths = db.execute(""" select count(distinct "time") from "link_lengths" """).fetchone()[0]
-num_counts = db.execute(""" select count(*) from "peer_count" """).fetchone()[0]
+version = db.execute("""PRAGMA user_version""").fetchone()[0]
 
-if num_lengths != num_counts:
-    print("Timestamp does not function as an identifier; cannot recalculate.")
+if version < 7:
+    print("Database version {0} does not store link lengths with peer counts; run probe.py to upgrade it.".format(version))
 else:
-    times = db.execute(""" select time from "peer_count" """).fetchall()
-
-    for time in times:
-        time = time[0]
-        peers = db.execute(""" select count(*) from "link_lengths" where "time" == '{0}'""".format(time)).fetchone()[0]
-        db.execute(""" update "peer_count" set "peers" = {0} where "time" == '{1}'""".format(peers, time))
-
+    db.execute(""" update "peer_count" set "peers" = length("lengths") / 8 where "lengths" is not null """)
     db.commit()
 
 db.close()
-
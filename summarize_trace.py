@@ -0,0 +1,56 @@
+from __future__ import division
+import argparse
+import json
+
+parser = argparse.ArgumentParser(description="Summarize a probe trace file written by probe.py: percentiles of the time spent in each stage, overall and per probe type.")
+parser.add_argument('traceFile', help='Trace file to summarize.')
+parser.add_argument('--by-node', dest='byNode', default=False, action='store_true',
+                    help='Also summarize per node.')
+
+args = parser.parse_args()
+
+# Each span is the time from the stage before it to its own stage. Traces of
+# results which were spooled rather than committed have no commit stage.
+spans = [ ("request", "created", "sent"),
+          ("network", "sent", "received"),
+          ("queued", "received", "handoff"),
+          ("pool wait", "handoff", "insert"),
+          ("insert+commit", "insert", "commit"),
+          ("total", "created", "commit") ]
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summarize(title, traces):
+    print("{0}: {1} traces".format(title, len(traces)))
+    print("  {0:<14} {1:>10} {2:>10} {3:>10} {4:>10}".format("stage (ms)", "p50", "p90", "p99", "max"))
+    for name, start, end in spans:
+        durations = sorted([ (trace[end] - trace[start]) * 1000 for trace in traces
+                             if start in trace and end in trace ])
+        if not durations:
+            continue
+        print("  {0:<14} {1:>10.1f} {2:>10.1f} {3:>10.1f} {4:>10.1f}".format(name,
+              percentile(durations, 0.5), percentile(durations, 0.9),
+              percentile(durations, 0.99), durations[-1]))
+
+traces = []
+with open(args.traceFile, 'r') as traceFile:
+    for line in traceFile:
+        try:
+            traces.append(json.loads(line))
+        except ValueError:
+            # The last line may be partial if probe.py is still running.
+            pass
+
+summarize("All", traces)
+
+groups = [ "type" ]
+if args.byNode:
+    groups.append("node")
+
+for group in groups:
+    for value in sorted(set([ trace.get(group) for trace in traces ])):
+        summarize("{0} {1}".format(group, value), [ trace for trace in traces if trace.get(group) == value ])
@@ -0,0 +1,63 @@
+import unittest
+import probe
+from fnprobe.scheduler import QuotaScheduler
+
+class Writer(object):
+	"""
+	Stands in for BatchWriter. Nothing is written when probes are dropped.
+	"""
+	def __init__(self):
+		self.listeners = []
+		self.paused = False
+
+	def add(self, result, trace=None):
+		raise AssertionError("Stored {0}.".format(result))
+
+class Connection(object):
+	"""
+	Stands in for FreenetClientProtocol, holding the sessions sent on it.
+	"""
+	def __init__(self):
+		self.sessions = {}
+
+	def do_session(self, request, hook):
+		self.sessions[request.id] = hook
+
+def arguments():
+	args = probe.Arguments()
+	args.types = [ "IDENTIFIER" ]
+	args.hopsToLive = 25
+	args.timeout = 95
+	args.maxPending = 10
+	args.congestionControl = False
+	args.node = "127.0.0.1:9481"
+	args.quotas = "IDENTIFIER:600,LOCATION:120"
+	args.identifierBoost = 2
+	args.minCollisions = 10
+	return args
+
+class DroppedTest(unittest.TestCase):
+	def test_dropped_probes_release_quota_slots(self):
+		args = arguments()
+		scheduler = QuotaScheduler(args)
+		factory = probe.FCPReconnectingFactory(args, Writer(), scheduler=scheduler)
+		factory.stopTrying()
+		connection = Connection()
+
+		for _ in range(3):
+			probe.SendHook(factory, connection)
+		self.assertEqual(sum(scheduler.inflight.values()), 3)
+
+		factory.clientConnectionLost(None, "Connection lost.")
+
+		self.assertEqual(scheduler.inflight, { "IDENTIFIER": 0, "LOCATION": 0 })
+		self.assertEqual(len(factory.inflight), 0)
+		self.assertEqual(connection.sessions, {})
+
+	def test_cancel_without_probes(self):
+		scheduler = QuotaScheduler(arguments())
+		scheduler.cancel("LOCATION")
+		self.assertEqual(scheduler.inflight["LOCATION"], 0)
+
+if __name__ == '__main__':
+	unittest.main()
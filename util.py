@@ -1,11 +1,11 @@
 from __future__ import division
-import sqlite3
 import argparse
 import locale
 import sys
 import datetime
 from string import upper
 from itertools import izip_longest
+from fnprobe.db import encode_probe_type, decode_probe_type, decode_error_type, rebuild_rollups, connect_writer, count_results
 
 locale.setlocale(locale.LC_ALL, '')
 
@@ -30,8 +30,8 @@ def times(func, tables):
     #None evaluates to False; remove None.
     return filter(None, results)
 
-choice = str(raw_input("Enter:\n * a to analyze\n * e to view per-type error breakdown\n * r to view mean response rate\n * s to view overall statistics\n * v to vaccuum (requires no open transactions or active SQL statements)\n * anything else to exit\n> "))
-with sqlite3.connect(args.databaseFile) as db:
+choice = str(raw_input("Enter:\n * a to analyze\n * e to view per-type error breakdown\n * n to view per-node response breakdown\n * r to view mean response rate\n * s to view overall statistics\n * u to rebuild hourly rollups\n * v to vaccuum (requires no open transactions or active SQL statements)\n * anything else to exit\n> "))
+with connect_writer(args.databaseFile) as db:
     if choice == 'a':
         print("Analyzing...")
         db.execute("analyze")
@@ -49,7 +49,7 @@ with sqlite3.connect(args.databaseFile) as db:
                     self.count += error[1]
 
         for probe_type in probe_types:
-            errors[probe_type] = error_occurences(db.execute("""select "error_type", count(*) from "error" where "probe_type" == '{0}' group by "error_type" """.format(probe_type)).fetchall())
+            errors[probe_type] = error_occurences(db.execute("""select "error_type", sum("count") from "error_hourly" where "probe_type" == ? group by "error_type" """, (encode_probe_type(probe_type),)).fetchall())
             total_count += errors[probe_type].count
 
         print("Errors stored: {0:n} total".format(total_count))
@@ -57,10 +57,28 @@ with sqlite3.connect(args.databaseFile) as db:
             error = errors[probe_type]
             print(" * {0}: {1:n} ({2:.1f}%)".format(probe_type, error.count, error.count/DivSafe(total_count)*100))
             for error_entry in error.error_list:
-                print(" *     {0}: {1:n} ({2:.1f}%)".format(error_entry[0], error_entry[1], error_entry[1]/DivSafe(error.count)*100))
+                print(" *     {0}: {1:n} ({2:.1f}%)".format(decode_error_type(error_entry[0]), error_entry[1], error_entry[1]/DivSafe(error.count)*100))
+
+    elif choice == 'n':
+        tables = [ "bandwidth", "build", "identifier", "peer_count", "location", "store_size", "uptime_48h", "uptime_7d" ]
+        # Results stored before database version 6 have no node.
+        nodes = [ (None, "Unknown") ] + db.execute("""select "id", "name" from "node" order by "name" """).fetchall()
+
+        def count(table, node):
+            return db.execute("""select count(*) from "{0}" where "node" is ?""".format(table), (node,)).fetchone()[0]
+
+        for node in nodes:
+            success = sum([ count(table, node[0]) for table in tables ])
+            refused = count("refused", node[0])
+            error = count("error", node[0])
+            responses = success + refused + error
+            if responses == 0:
+                continue
+
+            print(" * {0}: {1:n} responses, {2:n} successes ({3:.1f}%), {4:n} refused ({5:.1f}%), {6:n} error ({7:.1f}%)".format(node[1], responses, success, success/DivSafe(responses)*100, refused, refused/DivSafe(responses)*100, error, error/DivSafe(responses)*100))
 
     elif choice == 'r':
-        tables = [ "bandwidth", "build", "identifier", "link_lengths", "location", "store_size", "uptime_48h", "uptime_7d", "error", "refused" ]
+        tables = [ "bandwidth", "build", "identifier", "peer_count", "location", "store_size", "uptime_48h", "uptime_7d", "error", "refused" ]
         #TODO: It seems like there should be a function for
         timestampFormat = u"%Y-%m-%d %H:%M:%S.%f"
         first = datetime.datetime.strptime(min(times("min", tables)), timestampFormat)
@@ -69,10 +87,7 @@ with sqlite3.connect(args.databaseFile) as db:
         count = 0
 
         for table in tables:
-            if table == "link_lengths":
-                count += db.execute("""select count(*) from (select "time" from "link_lengths" group by "id")""").fetchone()[0]
-            else:
-                count += db.execute("""select count(*) from "{0}" """.format(table)).fetchone()[0]
+            count += db.execute("""select count(*) from "{0}" """.format(table)).fetchone()[0]
 
         # timedelta.total_seconds() was not added until 2.7. This is intended to run on 2.6 at least.
         # Minutes per day: 24 hours in a day * 60 minutes in an hour = 1440
@@ -85,22 +100,28 @@ with sqlite3.connect(args.databaseFile) as db:
         print("Average {0:.1f} results per minute.".format(count / minutes))
 
     elif choice == 's':
-        tables = [ "bandwidth", "build", "identifier", "link_lengths", "location", "store_size", "uptime_48h", "uptime_7d" ]
+        # Refusals and errors are counted from the hourly rollups, which are
+        # incomplete until the backfills after an upgrade finish.
+        pending = [ row[0] for row in db.execute("""select name from migration""") ]
+        if pending:
+            print("Background migrations are still running: {0}. Run probe.py until they finish to view statistics.".format(", ".join(pending)))
+            sys.exit(1)
+
+        tables = [ "bandwidth", "build", "identifier", "peer_count", "location", "store_size", "uptime_48h", "uptime_7d" ]
         #Use single quotes for values; double quotes for identifiers.
         success = []
         refused = []
         error = []
 
         for table in tables:
-            #link_lengths has one entry for each length, not each result.
-            if table == "link_lengths":
-                success.append(db.execute("""select count(*) from (select "time" from "link_lengths" group by "id")""").fetchone()[0])
-            else:
-                success.append(db.execute("""select count(*) from "{0}" """.format(table)).fetchone()[0])
+            # Includes compacted results, as the rollups do.
+            success.append(count_results(db, table))
 
-            #NOTE: Assumes probe_type value is uppercase table name.
-            refused.append(db.execute("""select count(*) from "refused" where "probe_type" == '{0}' """.format(upper(table))).fetchone()[0])
-            error.append(db.execute("""select count(*) from "error" where "probe_type" == '{0}' """.format(upper(table))).fetchone()[0])
+            #NOTE: Assumes probe_type value is uppercase table name, except for
+            #peer_count which holds LINK_LENGTHS results.
+            probe_type = "LINK_LENGTHS" if table == "peer_count" else upper(table)
+            refused.append(db.execute("""select coalesce(sum("count"), 0) from "refused_hourly" where "probe_type" == ?""", (encode_probe_type(probe_type),)).fetchone()[0])
+            error.append(db.execute("""select coalesce(sum("count"), 0) from "error_hourly" where "probe_type" == ?""", (encode_probe_type(probe_type),)).fetchone()[0])
 
         refusals = sum(refused)
         errors = sum(error)
@@ -114,22 +135,26 @@ with sqlite3.connect(args.databaseFile) as db:
             print(" * {0}: {1:n} responses ({2:.1f}%), {3:n} successes ({4:.1f}%)".format(table[0], responses, responses/DivSafe(total)*100, table[1], table[1]/DivSafe(total)*100))
             print("     * Of responses: {0:n} refused ({1:.1f}%), {2:n} error ({3:.1f}%)".format(table[2], table[2]/DivSafe(responses)*100, table[3], table[3]/DivSafe(responses)*100))
 
-            if table[0] == "identifier" or table[0] == "location":
-                duplicate = db.execute("""select count(distinct "{0}") from "{0}" """.format(table[0])).fetchone()[0]
+            if table[0] == "identifier":
+                duplicate = db.execute("""select count(distinct "identifier") from (select "identifier" from "identifier" union all select "identifier" from "identifier_hourly")""").fetchone()[0]
                 print("     * {0:n} distinct successes ({1:.1f}%)".format(duplicate, duplicate/DivSafe(table[1])*100))
+            elif table[0] == "location":
+                # Compacted locations are rounded, so only those not compacted are compared.
+                duplicate, stored = db.execute("""select count(distinct "location"), count(*) from "location" """).fetchone()
+                print("     * {0:n} distinct successes ({1:.1f}%)".format(duplicate, duplicate/DivSafe(stored)*100))
 
         print("Refusals stored: {0:n} total ({1:.1f}%)".format(refusals, refusals/DivSafe(total)*100))
-        for refusal in db.execute("""select "probe_type", count("probe_type") from "refused" group by "probe_type" order by "probe_type" """).fetchall():
-            print(" * {0}: {1:n} ({2:.1f}%)".format(refusal[0], refusal[1], refusal[1]/DivSafe(refusals)*100))
+        for refusal in db.execute("""select "probe_type", sum("count") from "refused_hourly" group by "probe_type" order by "probe_type" """).fetchall():
+            print(" * {0}: {1:n} ({2:.1f}%)".format(decode_probe_type(refusal[0]), refusal[1], refusal[1]/DivSafe(refusals)*100))
 
         print("Errors stored: {0:n} total ({1:.1f}%)".format(errors, errors/DivSafe(total)*100))
-        for error in db.execute("""select "error_type", count("error_type") from "error" group by "error_type" order by "error_type" """).fetchall():
-            print(" * {0}: {1:n} ({2:.1f}%)".format(error[0], error[1], error[1]/DivSafe(errors)*100))
+        for error in db.execute("""select "error_type", sum("count") from "error_hourly" group by "error_type" order by "error_type" """).fetchall():
+            print(" * {0}: {1:n} ({2:.1f}%)".format(decode_error_type(error[0]), error[1], error[1]/DivSafe(errors)*100))
 
         # NOTE: Locality information was added in database version 2.
-        localError = db.execute("""select count(*) from "error" where "local" == 'true'""").fetchone()[0]
-        remoteError = db.execute("""select count(*) from "error" where "local" == 'false'""").fetchone()[0]
-        noLocality = db.execute("""select count(*) from "error" where "local" is null""").fetchone()[0]
+        localError = db.execute("""select coalesce(sum("count"), 0) from "error_hourly" where "local" == 1""").fetchone()[0]
+        remoteError = db.execute("""select coalesce(sum("count"), 0) from "error_hourly" where "local" == 0""").fetchone()[0]
+        noLocality = db.execute("""select coalesce(sum("count"), 0) from "error_hourly" where "local" is null""").fetchone()[0]
         locality = localError + remoteError
         print(" * {0:n} ({1:.1f}%) errors with locality information were local.".format(localError, localError / DivSafe(locality) * 100))
         print(" * {0:n} ({1:.1f}%) errors have locality information.".format(locality, locality / DivSafe(errors) * 100))
@@ -138,6 +163,10 @@ with sqlite3.connect(args.databaseFile) as db:
         #TODO: This does not consider errors or refusals.
         print("Earliest response written {0}".format(min(times("min", tables))))
         print("Latest response written {0}".format(max(times("max", tables))))
+    elif choice == 'u':
+        print("Rebuilding hourly rollups...")
+        rebuild_rollups(db)
+        db.commit()
     elif choice == 'v':
         print("Vacuuming...")
         db.execute("vacuum")